@@ -0,0 +1,275 @@
+# In-process vector store for machines without Neo4j. Vectors live in a memory-mapped NumPy array and
+# are searched through an IVF index (k-means clusters, only the closest clusters are scanned); chunk text,
+# metadata and a BM25 index for hybrid search live in SQLite. One directory per embed model
+import json
+import math
+import os
+import sqlite3
+import threading
+from collections import Counter
+
+import numpy as np
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import MetadataMode, TextNode
+from llama_index.core.vector_stores.types import BasePydanticVectorStore, VectorStoreQueryMode, VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from backends import tokenize
+
+# Below this many chunks an exact scan is as fast as probing clusters
+BRUTE_FORCE_ROWS = 4096
+UNASSIGNED = -1
+DELETED = -2
+
+class LocalVectorStore(BasePydanticVectorStore):
+    stores_text: bool = True
+    path: str
+    dimension: int
+    nprobe: int = 8
+
+    _lock: object = PrivateAttr()
+    _db: object = PrivateAttr()
+    _vectors: object = PrivateAttr()
+    _assign: object = PrivateAttr()
+    _centroids: object = PrivateAttr()
+
+    def __init__(self, path, dimension, nprobe=8):
+        super().__init__(path=path, dimension=dimension, nprobe=nprobe)
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, "index.db"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS nodes (
+            row INTEGER PRIMARY KEY,
+            id TEXT UNIQUE NOT NULL,
+            doc_id TEXT,
+            text TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            length INTEGER NOT NULL
+        )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS nodes_doc_id ON nodes (doc_id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, row INTEGER NOT NULL, tf INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (term)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS postings_row ON postings (row)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.commit()
+        self._vectors = self._open_array("vectors.npy", (self._state("capacity", 1024), dimension), np.float32)
+        self._assign = self._open_array("assign.npy", (self._vectors.shape[0],), np.int32, fill=UNASSIGNED)
+        centroids_path = os.path.join(path, "centroids.npy")
+        self._centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+
+    @classmethod
+    def class_name(cls):
+        return "LocalVectorStore"
+
+    @property
+    def client(self):
+        return None
+
+    def _state(self, key, default=0):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def _open_array(self, name, shape, dtype, fill=0):
+        file = os.path.join(self.path, name)
+        if os.path.exists(file):
+            return np.lib.format.open_memmap(file, mode="r+")
+        array = np.lib.format.open_memmap(file, mode="w+", dtype=dtype, shape=shape)
+        array[:] = fill
+        return array
+
+    def _grow(self, rows):
+        # Doubles the arrays until they hold the given number of rows
+        capacity = self._vectors.shape[0]
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        for name, array, fill in (("vectors.npy", self._vectors, 0), ("assign.npy", self._assign, UNASSIGNED)):
+            file = os.path.join(self.path, name)
+            grown = np.lib.format.open_memmap(file + ".tmp", mode="w+", dtype=array.dtype, shape=(capacity,) + array.shape[1:])
+            grown[:array.shape[0]] = array
+            grown[array.shape[0]:] = fill
+            grown.flush()
+            del grown
+            array._mmap.close()
+            os.replace(file + ".tmp", file)
+        self._vectors = np.lib.format.open_memmap(os.path.join(self.path, "vectors.npy"), mode="r+")
+        self._assign = np.lib.format.open_memmap(os.path.join(self.path, "assign.npy"), mode="r+")
+        self._set_state("capacity", capacity)
+
+    def _remove_rows(self, rows):
+        if not rows:
+            return
+        self._assign[rows] = DELETED
+        marks = ",".join("?" * len(rows))
+        self._db.execute(f"DELETE FROM nodes WHERE row IN ({marks})", rows)
+        self._db.execute(f"DELETE FROM postings WHERE row IN ({marks})", rows)
+
+    def add(self, nodes, **add_kwargs):
+        with self._lock:
+            ids = [node.node_id for node in nodes]
+            # Re-adding a node replaces it
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                rows = [row for (row,) in self._db.execute(f"SELECT row FROM nodes WHERE id IN ({','.join('?' * len(batch))})", batch)]
+                self._remove_rows(rows)
+
+            first_row = self._state("next_row")
+            self._grow(first_row + len(nodes))
+            vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32).reshape(len(nodes), self.dimension)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            self._vectors[first_row:first_row + len(nodes)] = vectors
+            self._assign[first_row:first_row + len(nodes)] = self._nearest_centroids(vectors) if self._centroids is not None else UNASSIGNED
+
+            for row, node in enumerate(nodes, first_row):
+                text = node.get_content(metadata_mode=MetadataMode.NONE)
+                terms = Counter(tokenize(text))
+                metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=False)
+                self._db.execute("INSERT INTO nodes (row, id, doc_id, text, metadata, length) VALUES (?, ?, ?, ?, ?, ?)",
+                                 (row, node.node_id, node.ref_doc_id, text, json.dumps(metadata), sum(terms.values())))
+                self._db.executemany("INSERT INTO postings (term, row, tf) VALUES (?, ?, ?)", [(term, row, tf) for term, tf in terms.items()])
+            self._set_state("next_row", first_row + len(nodes))
+            self._vectors.flush()
+            self._assign.flush()
+            self._db.commit()
+
+            # Clusters are retrained as the corpus doubles
+            live = self._db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+            if live >= BRUTE_FORCE_ROWS and live >= 2 * self._state("trained_rows"):
+                self._train()
+        return ids
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        with self._lock:
+            self._remove_rows([row for (row,) in self._db.execute("SELECT row FROM nodes WHERE doc_id = ?", (ref_doc_id,))])
+            self._assign.flush()
+            self._db.commit()
+
+    def delete_nodes(self, node_ids):
+        with self._lock:
+            node_ids = list(node_ids)
+            for start in range(0, len(node_ids), 500):
+                batch = node_ids[start:start + 500]
+                self._remove_rows([row for (row,) in self._db.execute(f"SELECT row FROM nodes WHERE id IN ({','.join('?' * len(batch))})", batch)])
+            self._assign.flush()
+            self._db.commit()
+
+    def _nearest_centroids(self, vectors):
+        return np.argmax(vectors @ self._centroids.T, axis=1).astype(np.int32)
+
+    def _train(self, iterations=10):
+        # Spherical k-means on a sample, then every live row is assigned to its closest centroid
+        rows = np.nonzero(self._assign[:self._state("next_row")] != DELETED)[0]
+        clusters = min(1024, int(math.sqrt(len(rows))))
+        generator = np.random.default_rng(0)
+        sample = self._vectors[np.sort(generator.choice(rows, size=min(len(rows), 256 * clusters), replace=False))]
+        centroids = sample[generator.choice(len(sample), size=clusters, replace=False)].copy()
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for cluster in range(clusters):
+                members = sample[labels == cluster]
+                if len(members):
+                    centroids[cluster] = members.sum(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+
+        self._centroids = centroids
+        for start in range(0, len(rows), 65536):
+            batch = rows[start:start + 65536]
+            self._assign[batch] = self._nearest_centroids(self._vectors[batch])
+        self._assign.flush()
+        np.save(os.path.join(self.path, "centroids.npy"), centroids)
+        self._set_state("trained_rows", len(rows))
+        self._db.commit()
+
+    def _vector_search(self, embedding, top_k):
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+        assign = self._assign[:self._state("next_row")]
+        if self._centroids is None:
+            rows = np.nonzero(assign != DELETED)[0]
+        else:
+            probe = np.argsort(self._centroids @ query)[::-1][:self.nprobe]
+            # Rows added since the last training have no cluster yet and are always scanned
+            rows = np.nonzero(np.isin(assign, probe) | (assign == UNASSIGNED))[0]
+        if not len(rows):
+            return {}
+        scores = self._vectors[rows] @ query
+        best = np.argsort(scores)[::-1][:top_k]
+        # Same 0..1 range as Neo4j's cosine scores
+        return {int(rows[i]): (float(scores[i]) + 1) / 2 for i in best}
+
+    def _keyword_search(self, text, top_k):
+        terms = set(tokenize(text))
+        if not terms:
+            return {}
+        count, average_length = self._db.execute("SELECT COUNT(*), AVG(length) FROM nodes").fetchone()
+        if not count:
+            return {}
+        marks = ",".join("?" * len(terms))
+        postings = self._db.execute(f"""SELECT postings.term, postings.row, postings.tf, nodes.length FROM postings
+            JOIN nodes ON nodes.row = postings.row WHERE postings.term IN ({marks})""", list(terms)).fetchall()
+        frequencies = Counter(term for term, _, _, _ in postings)
+        scores = Counter()
+        k1, b = 1.2, 0.75
+        for term, row, tf, length in postings:
+            idf = math.log(1 + (count - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+            scores[row] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / (average_length or 1)))
+        best = scores.most_common(top_k)
+        top = best[0][1] if best else 1.0
+        # Normalized by the best hit, like the Neo4j full-text branch
+        return {row: score / top for row, score in best}
+
+    def query(self, query, **kwargs):
+        if query.filters is not None:
+            raise ValueError("Metadata filters are not supported by the local vector store")
+        top_k = (query.hybrid_top_k or query.similarity_top_k) if query.mode == VectorStoreQueryMode.HYBRID else query.similarity_top_k
+        if query.mode == VectorStoreQueryMode.HYBRID:
+            alpha = 0.5 if query.alpha is None else query.alpha
+        elif query.mode in (VectorStoreQueryMode.TEXT_SEARCH, VectorStoreQueryMode.SPARSE):
+            alpha = 0.0
+        elif query.mode == VectorStoreQueryMode.DEFAULT:
+            alpha = 1.0
+        else:
+            raise ValueError(f"Query mode {query.mode} is not supported by the local vector store")
+
+        with self._lock:
+            scores = Counter()
+            if alpha > 0 and query.query_embedding is not None:
+                for row, score in self._vector_search(query.query_embedding, top_k).items():
+                    scores[row] += alpha * score
+            if alpha < 1 and query.query_str:
+                for row, score in self._keyword_search(query.query_str, top_k).items():
+                    scores[row] += (1 - alpha) * score
+            best = scores.most_common(top_k)
+            if query.doc_ids:
+                allowed = {row for (row,) in self._db.execute(
+                    f"SELECT row FROM nodes WHERE doc_id IN ({','.join('?' * len(query.doc_ids))})", query.doc_ids)}
+                best = [(row, score) for row, score in best if row in allowed]
+            records = {}
+            if best:
+                marks = ",".join("?" * len(best))
+                for row, node_id, text, metadata in self._db.execute(f"SELECT row, id, text, metadata FROM nodes WHERE row IN ({marks})", [row for row, _ in best]):
+                    records[row] = (node_id, text, json.loads(metadata))
+
+        nodes, similarities, ids = [], [], []
+        for row, score in best:
+            node_id, text, metadata = records[row]
+            try:
+                node = metadata_dict_to_node(metadata)
+                node.set_content(text)
+            except Exception:
+                node = TextNode(text=text, id_=node_id, metadata=metadata)
+            nodes.append(node)
+            similarities.append(score)
+            ids.append(node_id)
+        return VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=ids)
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._assign.flush()
+            self._db.close()
@@ -1,5 +1,9 @@
 import os
 import sys
+import time
+
+# Reported as time-to-listening and time-to-ready
+startup_clock = time.perf_counter()
 
 if getattr(sys, 'frozen', False):
     # If the application is running as a bundled executable
@@ -11,29 +15,111 @@ else:
 os.environ["TIKTOKEN_CACHE_DIR"] = os.path.join(bundle_dir, 'tiktoken_cache')
 os.environ["NLTK_DATA"] = os.path.join(bundle_dir, 'nltk_data')
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Request, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 # Uncomment the line under to use FlaskUI
 # from flaskwebgui import FlaskUI
 from flask_swagger_ui import get_swaggerui_blueprint
-from llama_index.llms.ollama import Ollama
-from llama_index.embeddings.ollama import OllamaEmbedding
-from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
-from llama_index.core.prompts import ChatMessage
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core import Settings, VectorStoreIndex, StorageContext, SimpleDirectoryReader
-from datetime import datetime, timedelta
-from tempfile import TemporaryDirectory
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import dump_cookie, parse_cookie
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from metrics import registry, ollama_seconds, ollama_errors, neo4j_seconds, neo4j_errors
+from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 import ollama
+import numpy as np
 import json
 import traceback
-import time
-from tqdm import tqdm
+import threading
+import hashlib
+import atexit
+import sqlite3
+import secrets
+import queue
+import re
+import multiprocessing
+import shutil
+import socket
+import math
+import asyncio
+import uvicorn
 import subprocess
 import platform
 
+# Files uploaded to add_new_documents are streamed straight into a staging directory instead of
+# being spooled to a temporary file and copied, and the request body is capped by max_upload_bytes
+UPLOAD_PATH = '/api/add_new_documents'
+
+class UploadRequest(Request):
+    @property
+    def max_content_length(self):
+        if self.path == UPLOAD_PATH:
+            return settings["max_upload_bytes"]
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path != UPLOAD_PATH:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        if not hasattr(self, "upload_dir"):
+            self.upload_dir = os.path.join("uploads", new_ordered_id())
+            self.upload_count = 0
+            os.makedirs(self.upload_dir, exist_ok=True)
+        self.upload_count += 1
+        return open(os.path.join(self.upload_dir, f"{self.upload_count}.part"), 'w+b')
+
 app = Flask(__name__, static_folder='web/build', static_url_path='/')
+app.request_class = UploadRequest
+
+# Prometheus metrics, served at /metrics (see metrics.py). Request counts and latency per route come
+# from a WSGI middleware, labelled with the Flask endpoint name
+http_requests = registry.counter("tok_http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+http_request_seconds = registry.histogram("tok_http_request_seconds", "Time until the response body was sent, by route", ("route",))
+streams_active = registry.gauge("tok_streams_active", "Answers currently streaming")
+query_first_token_seconds = registry.histogram("tok_query_first_token_seconds", "Time to the first token of an answer, by model", ("model",))
+query_tokens_per_second = registry.histogram("tok_query_tokens_per_second", "Generation speed of an answer, by model", ("model",),
+                                             buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200))
+query_tokens = registry.counter("tok_query_tokens_total", "Streamed tokens, by model", ("model",))
+ingested_files = registry.counter("tok_ingest_files_total", "Files handled by ingestion, by result", ("result",))
+ingested_documents = registry.counter("tok_ingest_documents_total", "Documents parsed by ingestion")
+ingested_chunks = registry.counter("tok_ingest_chunks_total", "Chunks handled by ingestion, by action", ("action",))
+neo4j_acquire_seconds = registry.histogram("tok_neo4j_acquire_seconds", "Wait for a Neo4j pool connection")
+
+def observe_request(route, method, status, seconds):
+    http_requests.inc(route, method, status)
+    http_request_seconds.observe(seconds, route)
+
+class MetricsMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = []
+
+        def metered_start_response(status_line, headers, exc_info=None):
+            status[:] = [status_line.split(" ", 1)[0]]
+            return start_response(status_line, headers, exc_info)
+
+        # A streamed answer is only done when the server closes its body
+        body = self.wsgi_app(environ, metered_start_response)
+        return ClosingIterator(body, lambda: observe_request(environ.get("tok.endpoint") or "none", environ["REQUEST_METHOD"],
+                                                             status[0] if status else "", time.perf_counter() - start))
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+@app.url_value_preprocessor
+def tag_endpoint(endpoint, values):
+    request.environ["tok.endpoint"] = endpoint
 ollama_process = None
+# The Ollama started by start_services; every direct call to its API goes through this client
+ollama_client = ollama.Client(host="http://localhost:11434")
 CORS(app)
 
 # Path to your Swagger YAML file
@@ -50,6 +136,52 @@ swaggerui_blueprint = get_swaggerui_blueprint(
 )
 app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 
+# Set by import_backends() on the startup thread, see backends.py
+Ollama = OllamaEmbedding = Neo4jVectorStore = ChatMessage = ChatMemoryBuffer = None
+Settings = VectorStoreIndex = StorageContext = SimpleDirectoryReader = MetadataMode = None
+CachedEmbedding = SummaryChatMemory = neo4j = None
+CallbackManager = CondensePlusContextChatEngine = ContextChatEngine = SentenceTransformerRerank = None
+Neo4jHybridRetriever = LexicalReranker = StageTimer = LocalVectorStore = None
+QueryTrace = current_trace = None
+
+def import_backends():
+    global Ollama, OllamaEmbedding, Neo4jVectorStore, ChatMessage, ChatMemoryBuffer
+    global Settings, VectorStoreIndex, StorageContext, SimpleDirectoryReader, MetadataMode
+    global CachedEmbedding, SummaryChatMemory, neo4j
+    global CallbackManager, CondensePlusContextChatEngine, ContextChatEngine, SentenceTransformerRerank
+    global Neo4jHybridRetriever, LexicalReranker, StageTimer, LocalVectorStore
+    global QueryTrace, current_trace
+    from backends import (Ollama, OllamaEmbedding, Neo4jVectorStore, ChatMessage, ChatMemoryBuffer,
+        Settings, VectorStoreIndex, StorageContext, SimpleDirectoryReader, MetadataMode, CachedEmbedding,
+        SummaryChatMemory, neo4j, CallbackManager, CondensePlusContextChatEngine, ContextChatEngine,
+        SentenceTransformerRerank, Neo4jHybridRetriever, LexicalReranker, StageTimer, QueryTrace, current_trace)
+    from local_store import LocalVectorStore
+
+# The server binds before the backends are up: startup continues on a background thread and reports
+# each step to /api/ready. Until it is done, API routes that need the backends answer 503
+startup_steps = OrderedDict((name, {"state": "pending", "seconds": None, "error": None})
+                            for name in ("services", "backends", "models", "llm", "vector_store", "ingest"))
+startup_done = threading.Event()
+startup_times = {"listening": None, "ready": None}
+
+@contextmanager
+def startup_step(name):
+    step = startup_steps[name]
+    step["state"] = "starting"
+    start = time.perf_counter()
+    try:
+        yield
+        step["state"] = "ready"
+    except Exception as e:
+        step.update(state="failed", error=str(e))
+        raise
+    finally:
+        step["seconds"] = round(time.perf_counter() - start, 3)
+
+def report_listening(url):
+    startup_times["listening"] = round(time.perf_counter() - startup_clock, 3)
+    print(f"Listening on {url} after {startup_times['listening']:.2f}s")
+
 def start_services():
     global ollama_process
     try:
@@ -69,7 +201,48 @@ def start_services():
     except Exception as e:
         print("Error starting services: ", e)
         traceback.print_exc()
-        exit(1)
+        raise
+
+# Settings added after the first release, filled in when missing from settings.json
+optional_settings = {
+    "max_sessions": 32,
+    "session_idle_timeout": 3600,
+    "session_fsync_every": 8,
+    "session_fsync_interval": 2.0,
+    "history_replay_turns": 20,
+    "ingest_workers": max(1, (os.cpu_count() or 2) - 1),
+    "embed_batch_size": 32,
+    "embed_concurrency": 4,
+    "insert_batch_size": 500,
+    "ingest_window": 1000,
+    "max_upload_bytes": 2 * 1024 ** 3,
+    "embed_cache_entries": 50000,
+    "embed_cache_dtype": "float16",
+    "response_cache": False,
+    "response_cache_threshold": 0.95,
+    "response_cache_ttl": 3600,
+    "response_cache_entries": 256,
+    "neo4j_max_pool_size": 50,
+    "neo4j_max_connection_lifetime": 3600,
+    "neo4j_acquisition_timeout": 60,
+    "neo4j_fetch_size": 1000,
+    "async_server": False,
+    "llm_max_concurrency": 2,
+    "llm_max_queue": 16,
+    "llm_queue_timeout": 30,
+    "keep_alive": "30m",
+    "keep_alive_refresh": 240,
+    "memory_mode": "buffer",
+    "memory_recent_turns": 6,
+    "memory_summarize_every": 3,
+    "similarity_top_k": 2,
+    "hybrid_alpha": 0.5,
+    "rerank": "none",
+    "rerank_top_n": 2,
+    "cross_encoder_model": "cross-encoder/ms-marco-MiniLM-L-6-v2",
+    "vector_backend": "neo4j",
+    "ivf_nprobe": 8
+}
 
 # Function to create the prev_msgs directory if it doesn't exist
 def create_directory_if_not_exists(directory):
@@ -105,6 +278,9 @@ def load_settings():
         with open('settings.json', 'w+') as f:
             json.dump(settings, f)
 
+    for key, value in optional_settings.items():
+        settings.setdefault(key, value)
+
 # Load prompts from file
 def load_prompts():
     global prompts
@@ -144,188 +320,1857 @@ def load_models():
         with open('models.json', 'w+') as f:
             json.dump(models, f)
     finally:
-        ollama_models = [model["name"] for model in ollama.list()['models']]
+        models.setdefault("dimensions", {})
+        ollama_models = [model["name"] for model in ollama_client.list()['models']]
+        # Missing default models are pulled in the background, progress is in /api/pull_jobs
         if "mistral:instruct" not in ollama_models:
             print("Loading default llm...")
-            current_digest, bars = '', {}
-            for progress in ollama.pull("mistral:instruct", stream=True):
-                digest = progress.get('digest', '')
-                if digest != current_digest and current_digest in bars:
-                    bars[current_digest].close()
-
-                if not digest:
-                    print(progress.get('status'))
-                    continue
-
-                if digest not in bars and (total := progress.get('total')):
-                    bars[digest] = tqdm(total=total, desc=f'pulling {digest[7:19]}', unit='B', unit_scale=True)
-
-                if completed := progress.get('completed'):
-                    bars[digest].update(completed - bars[digest].n)
-
-                current_digest = digest
+            start_pull("mistral:instruct", "llm")
         if "mxbai-embed-large:latest" not in ollama_models:
             print("Loading default embed model...")
-            current_digest, bars = '', {}
-            for progress in ollama.pull("mxbai-embed-large:latest", stream=True):
-                digest = progress.get('digest', '')
-                if digest != current_digest and current_digest in bars:
-                    bars[current_digest].close()
-
-                if not digest:
-                    print(progress.get('status'))
-                    continue
-
-                if digest not in bars and (total := progress.get('total')):
-                    bars[digest] = tqdm(total=total, desc=f'pulling {digest[7:19]}', unit='B', unit_scale=True)
-
-                if completed := progress.get('completed'):
-                    bars[digest].update(completed - bars[digest].n)
-
-                current_digest = digest
+            start_pull("mxbai-embed-large:latest", "embed")
 
 # Initialize global variables
 def initialize_globals():
-    global llm, vector_store, vector_index, storage_context, chat_engine, memory, models, current_model, current_embed_model, settings, prompts, selected_LLM_prompt, selected_chat_engine_prompt
+    global llm, models, current_model, current_embed_model, selected_LLM_prompt, selected_chat_engine_prompt, stage_timer
 
     try:
-        load_settings()
-        load_prompts()
-        load_models()
-        current_model = "mistral:instruct"
-        current_embed_model = "mxbai-embed-large:latest"
-
-        # Initialize the embed model
-        embed_model = OllamaEmbedding(model_name=current_embed_model, base_url="http://localhost:11434")
-        Settings.embed_model = embed_model
-        llm = Ollama(model=current_model, request_timeout=120.0, base_url="http://localhost:11434", temperature=settings["temperature"], context_window=settings["context_window"])
-        Settings.llm = llm
-        Settings.chunk_size = settings["chunk_size"]
-        Settings.chunk_overlap = settings["chunk_overlap"]
-
-        # Initialize LLM
-        print("LLM initialized successfully")
-
-        selected_LLM_prompt = prompts["LLM"]["prompts"][prompts["LLM"]["default"]]
-        selected_chat_engine_prompt = prompts["Chat Engine"]["prompts"][prompts["Chat Engine"]["default"]]
-
-        # Initialize Neo4j vector store and other components
-        vector_store = Neo4jVectorStore(settings['database'], settings['password'], settings['uri'], 1024, hybrid_search=True)
-        vector_index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        memory = ChatMemoryBuffer.from_defaults(token_limit=settings["token_limit"])
-        chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-            context_prompt=(
-                selected_chat_engine_prompt["value"]
-            ), memory=memory, verbose=True
-        )
-        print("Vector store and chat engine initialized successfully")
+        with startup_step("services"):
+            start_services()
+
+        with startup_step("backends"):
+            import_backends()
+
+        with startup_step("models"):
+            load_models()
+            current_model = "mistral:instruct"
+            current_embed_model = "mxbai-embed-large:latest"
+
+        with startup_step("llm"):
+            # Components built from here on report their stage timings
+            stage_timer = StageTimer()
+            Settings.callback_manager = CallbackManager([stage_timer])
+
+            # Initialize the embed model
+            embed_model = make_embed_model(current_embed_model)
+            Settings.embed_model = embed_model
+            llm = Ollama(model=current_model, request_timeout=120.0, base_url="http://localhost:11434", temperature=settings["temperature"], context_window=settings["context_window"])
+            Settings.llm = llm
+            Settings.chunk_size = settings["chunk_size"]
+            Settings.chunk_overlap = settings["chunk_overlap"]
+
+            # Initialize LLM
+            print("LLM initialized successfully")
+            threading.Thread(target=title_worker, daemon=True).start()
+            threading.Thread(target=summary_worker, daemon=True).start()
+            # Load both models in the background so the first query doesn't pay for it
+            model_residency.pin(current_model, current_embed_model)
+            threading.Thread(target=model_residency.run, daemon=True).start()
+
+            selected_LLM_prompt = prompts["LLM"]["prompts"][prompts["LLM"]["default"]]
+            selected_chat_engine_prompt = prompts["Chat Engine"]["prompts"][prompts["Chat Engine"]["default"]]
+
+        with startup_step("vector_store"):
+            # On a first run the embed model may still be downloading, and the store needs its dimension
+            wait_for_pull(current_embed_model)
+            # Initialize Neo4j vector store and other components
+            use_vector_store(current_embed_model)
+            print("Vector store initialized successfully")
+
+        with startup_step("ingest"):
+            init_manifest()
+            resume_ingest_jobs()
+            threading.Thread(target=ingest_worker, daemon=True).start()
 
     except Exception as e:
         print("Initialization error: ", e)
         traceback.print_exc()
+    finally:
+        startup_times["ready"] = round(time.perf_counter() - startup_clock, 3)
+        startup_done.set()
+        print(f"Startup finished after {startup_times['ready']:.2f}s")
+
+# On-disk embedding cache per embed model, keyed by a hash of the normalized text. Vectors live in a
+# memory-mapped array and the key -> row index with LRU bookkeeping in SQLite
+# Hits only note their time in memory; the times are written in one batch this often, or when an insert
+# needs them to pick what to evict. A crash loses some recency, never entries
+TOUCH_BATCH = 256
+TOUCH_INTERVAL = 5.0
+
+class EmbeddingCache:
+    def __init__(self, model_name, capacity, dtype):
+        self.model_name = model_name
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.dir = os.path.join("embed_cache", hashlib.sha1(model_name.encode()).hexdigest()[:16])
+        self.vectors = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        create_directory_if_not_exists(self.dir)
+        self.db = sqlite3.connect(os.path.join(self.dir, "index.db"), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, row INTEGER UNIQUE NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.db.commit()
+        # Rows are handed out in order until the cache is full, so the count is also the next free row
+        self.count = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        self.touched = {}
+        self.touched_flushed = time.time()
+        vectors_path = os.path.join(self.dir, "vectors.npy")
+        if os.path.exists(vectors_path):
+            vectors = np.lib.format.open_memmap(vectors_path, mode='r+')
+            if vectors.shape[0] == capacity and vectors.dtype == self.dtype:
+                self.vectors = vectors
+            else:
+                del vectors
+                self.clear()
+
+    def clear(self):
+        self.vectors = None
+        self.touched.clear()
+        self.db.execute("DELETE FROM entries")
+        self.db.commit()
+        self.count = 0
+        vectors_path = os.path.join(self.dir, "vectors.npy")
+        if os.path.exists(vectors_path):
+            os.remove(vectors_path)
+
+    def key(self, kind, text):
+        return hashlib.sha256(f"{self.model_name}\0{kind}\0{' '.join(text.split())}".encode("utf-8")).hexdigest()
+
+    def lookup_rows(self, keys):
+        rows = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows.update(self.db.execute(f"SELECT key, row FROM entries WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+        return rows
+
+    def flush_touched(self):
+        if self.touched:
+            self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key, now in self.touched.items()])
+            self.db.commit()
+            self.touched.clear()
+        self.touched_flushed = time.time()
+
+    def get_many(self, kind, texts):
+        keys = [self.key(kind, text) for text in texts]
+        results = [None] * len(texts)
+        with self.lock:
+            if self.vectors is None:
+                self.misses += len(texts)
+                return results
+            rows = self.lookup_rows(keys)
+            for i, key in enumerate(keys):
+                if key in rows:
+                    results[i] = self.vectors[rows[key]].astype(np.float32).tolist()
+            if rows:
+                now = time.time()
+                self.touched.update((key, now) for key in rows)
+                if len(self.touched) >= TOUCH_BATCH or now - self.touched_flushed >= TOUCH_INTERVAL:
+                    self.flush_touched()
+            self.hits += len(rows)
+            self.misses += len(texts) - len(rows)
+        return results
+
+    def put_many(self, kind, texts, embeddings):
+        if not texts:
+            return
+        with self.lock:
+            dimension = len(embeddings[0])
+            if self.vectors is None or self.vectors.shape[1] != dimension:
+                self.clear()
+                self.vectors = np.lib.format.open_memmap(os.path.join(self.dir, "vectors.npy"), mode='w+', dtype=self.dtype, shape=(self.capacity, dimension))
+            now = time.time()
+            # Of a batch larger than the cache only the last entries fit
+            entries = {self.key(kind, text): embedding for text, embedding in zip(texts, embeddings)}
+            keys = list(entries)[-self.capacity:]
+            rows = self.lookup_rows(keys)
+            new_keys = [key for key in keys if key not in rows]
+            free = min(len(new_keys), self.capacity - self.count)
+            rows.update((key, self.count + i) for i, key in enumerate(new_keys[:free]))
+            self.count += free
+            if len(new_keys) > free:
+                # Full: reuse the least recently used rows. The batch's own entries are touched first, so
+                # none of them is picked
+                self.touched.update((key, now) for key in keys if key in rows)
+                self.flush_touched()
+                stale = self.db.execute("SELECT key, row FROM entries ORDER BY last_used LIMIT ?", (len(new_keys) - free,)).fetchall()
+                self.db.executemany("DELETE FROM entries WHERE key = ?", [(stale_key,) for stale_key, _ in stale])
+                rows.update((key, row) for key, (_, row) in zip(new_keys[free:], stale))
+            for key in keys:
+                self.vectors[rows[key]] = np.asarray(entries[key], dtype=self.dtype)
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", [(key, rows[key], now) for key in keys])
+            self.vectors.flush()
+            self.db.commit()
+
+    def cached(self, kind, texts, compute):
+        results = self.get_many(kind, texts)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            computed = compute([texts[i] for i in missing])
+            self.put_many(kind, [texts[i] for i in missing], computed)
+            for i, embedding in zip(missing, computed):
+                results[i] = embedding
+        return results
+
+embedding_caches = {}
+embedding_caches_lock = threading.Lock()
+
+def embedding_cache(model_name):
+    # Caches stay open across model switches, switching back to a model reuses its vectors
+    with embedding_caches_lock:
+        cache = embedding_caches.get(model_name)
+        if cache is None:
+            cache = EmbeddingCache(model_name, settings["embed_cache_entries"], settings["embed_cache_dtype"])
+            embedding_caches[model_name] = cache
+        return cache
+
+def make_embed_model(model_name):
+    return CachedEmbedding(OllamaEmbedding(model_name=model_name, base_url="http://localhost:11434"), embedding_cache(model_name))
+
+# Opt-in semantic cache of complete answers. Entries are partitioned by model, mode, prompt, index
+# version and chat history, and a lookup matches on cosine similarity of the question's embedding
+class ResponseCache:
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, partition, vector):
+        now = time.time()
+        with self.lock:
+            best_key, best_score = None, settings["response_cache_threshold"]
+            for key, entry in list(self.entries.items()):
+                if now - entry["created"] > settings["response_cache_ttl"]:
+                    del self.entries[key]
+                elif entry["partition"] == partition:
+                    score = float(np.dot(entry["vector"], vector))
+                    if score >= best_score:
+                        best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key]["answer"]
+
+    def put(self, partition, vector, answer):
+        with self.lock:
+            self.entries[secrets.token_hex(8)] = {"partition": partition, "vector": vector, "answer": answer, "created": time.time()}
+            while len(self.entries) > settings["response_cache_entries"]:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": len(self.entries)}
+
+response_cache = ResponseCache()
+
+def history_key(memory):
+    # A follow-up question only means the same thing after the same history. Hashing the history instead of
+    # condensing the question keeps a cache miss at the one condense call the chat engine makes itself
+    history = memory.get()
+    return hash_text("\0".join(f"{message.role.value}\0{(message.content or '').strip()}" for message in history)) if history else None
+
+def response_cache_key(use_chat_engine, memory, query):
+    if use_chat_engine:
+        partition = (current_model, settings["chat_mode"], selected_chat_engine_prompt["value"], index_version, history_key(memory))
+    else:
+        partition = (current_model, "llm", selected_LLM_prompt["value"], index_version, history_key(memory))
+    vector = np.asarray(Settings.embed_model.get_query_embedding(query), dtype=np.float32)
+    return partition, vector / (np.linalg.norm(vector) or 1.0)
+
+def replay_response(answer):
+    # Stream a cached answer word by word, like the model would
+    for token in re.findall(r'\S+\s*|\s+', answer):
+        yield token
+
+def bump_index_version():
+    # Chat engines pick up index changes on their next use; cached answers are no longer valid
+    global index_version
+    index_version += 1
+    response_cache.clear()
+
+# Keeps the current LLM and embed model loaded in Ollama. Every request that doesn't set a keep-alive
+# resets a model to Ollama's default, so pinned models are warmed again on a timer shorter than that
+class ModelResidency:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pinned = {}
+        self.unpinned = {}
+        self.warmups = {}
+
+    def pin(self, llm_model, embed_model):
+        # Models that are no longer current are unloaded to make room for the new ones
+        with self.lock:
+            targets = {llm_model: "llm", embed_model: "embed"}
+            self.unpinned.update({model: kind for model, kind in self.pinned.items() if model not in targets})
+            self.pinned = targets
+        self.wake.set()
+
+    def request(self, model, kind, keep_alive):
+        with ollama_seconds.time("keep_alive", errors=ollama_errors):
+            if kind == "llm":
+                ollama_client.generate(model=model, prompt="", keep_alive=keep_alive)
+            else:
+                ollama_client.embed(model=model, input="warm up", keep_alive=keep_alive)
+
+    def warm(self, model, kind):
+        start = time.perf_counter()
+        try:
+            with llm_scheduler.slot("residency", LLMScheduler.BACKGROUND):
+                self.request(model, kind, settings["keep_alive"])
+            status = {"kind": kind, "warmed_at": str(datetime.now()), "seconds": round(time.perf_counter() - start, 3), "error": None}
+        except Exception as e:
+            print(f"Could not warm up {model}: {e}")
+            status = {"kind": kind, "warmed_at": None, "seconds": None, "error": str(e)}
+        with self.lock:
+            if model in self.pinned:
+                self.warmups[model] = status
+
+    def run(self):
+        while True:
+            self.wake.wait(settings["keep_alive_refresh"])
+            self.wake.clear()
+            with self.lock:
+                pinned, unpinned = dict(self.pinned), self.unpinned
+                self.unpinned = {}
+                for model in unpinned:
+                    self.warmups.pop(model, None)
+            for model, kind in unpinned.items():
+                try:
+                    self.request(model, kind, 0)
+                except Exception as e:
+                    print(f"Could not unload {model}: {e}")
+            for model, kind in pinned.items():
+                self.warm(model, kind)
+
+    def status(self):
+        with self.lock:
+            status = {"keep_alive": settings["keep_alive"], "pinned": dict(self.warmups), "resident": [], "error": None}
+        try:
+            for model in ollama_client.ps()["models"]:
+                status["resident"].append({"name": model["name"], "size": model.get("size"), "size_vram": model.get("size_vram"),
+                                           "expires_at": str(model.get("expires_at"))})
+        except Exception as e:
+            status["error"] = str(e)
+        return status
+
+model_residency = ModelResidency()
+
+# A single Neo4j driver (and connection pool) shared by every vector store. Connection acquisitions
+# are timed so pool pressure shows up in /api/neo4j_pool
+neo4j_driver = None
+neo4j_driver_lock = threading.Lock()
+neo4j_stats_lock = threading.Lock()
+neo4j_pool_stats = {"acquisitions": 0, "acquire_seconds_total": 0.0, "acquire_seconds_max": 0.0}
+# A retired driver is closed once its queries are done, or after as long as an answer may take
+NEO4J_DRAIN_SECONDS = 120
+
+def timed_acquire(acquire):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return acquire(*args, **kwargs)
+        except Exception:
+            neo4j_errors.inc("acquire")
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            neo4j_acquire_seconds.observe(waited)
+            with neo4j_stats_lock:
+                neo4j_pool_stats["acquisitions"] += 1
+                neo4j_pool_stats["acquire_seconds_total"] += waited
+                neo4j_pool_stats["acquire_seconds_max"] = max(neo4j_pool_stats["acquire_seconds_max"], waited)
+    return wrapper
+
+def get_neo4j_driver():
+    global neo4j_driver
+    with neo4j_driver_lock:
+        if neo4j_driver is None:
+            neo4j_driver = neo4j.GraphDatabase.driver(settings['uri'], auth=(settings['database'], settings['password']),
+                max_connection_pool_size=settings["neo4j_max_pool_size"],
+                max_connection_lifetime=settings["neo4j_max_connection_lifetime"],
+                connection_acquisition_timeout=settings["neo4j_acquisition_timeout"],
+                fetch_size=settings["neo4j_fetch_size"])
+            # The pool is driver internals; without it only the usage counts are lost
+            pool = getattr(neo4j_driver, "_pool", None)
+            if pool is not None and hasattr(pool, "acquire"):
+                pool.acquire = timed_acquire(pool.acquire)
+        return neo4j_driver
+
+def current_neo4j_driver():
+    # The driver in use, None before the first store opened one
+    with neo4j_driver_lock:
+        return neo4j_driver
+
+def retire_neo4j_driver():
+    # Stores opened from now on get a driver for the current connection settings, the old one is closed
+    # in the background once the queries still running on it are done
+    global neo4j_driver
+    with neo4j_driver_lock:
+        old_driver, neo4j_driver = neo4j_driver, None
+    if old_driver is not None:
+        threading.Thread(target=drain_neo4j_driver, args=(old_driver,), daemon=True).start()
+
+def drain_neo4j_driver(driver):
+    deadline = time.perf_counter() + NEO4J_DRAIN_SECONDS
+    # A pool that can't be read counts as busy
+    while time.perf_counter() < deadline and pool_connections(driver)[0] != 0:
+        time.sleep(0.5)
+    driver.close()
+
+def close_neo4j_driver():
+    global neo4j_driver
+    with neo4j_driver_lock:
+        if neo4j_driver is not None:
+            neo4j_driver.close()
+            neo4j_driver = None
+
+def pool_connections(driver):
+    # Connections in use and idle, (None, None) when the pool can't be read
+    pool = getattr(driver, "_pool", None)
+    try:
+        connections = [connection for address_connections in list(pool.connections.values()) for connection in address_connections]
+        in_use = sum(1 for connection in connections if connection.in_use)
+        return in_use, len(connections) - in_use
+    except Exception:
+        return None, None
+
+def neo4j_pool_usage():
+    with neo4j_stats_lock:
+        usage = {"max_size": settings["neo4j_max_pool_size"], "in_use": None, "idle": None, **neo4j_pool_stats}
+    usage["acquire_seconds_avg"] = usage["acquire_seconds_total"] / usage["acquisitions"] if usage["acquisitions"] else 0.0
+    driver = current_neo4j_driver()
+    if driver is not None:
+        usage["in_use"], usage["idle"] = pool_connections(driver)
+    return usage
+
+atexit.register(close_neo4j_driver)
+
+# One Neo4j vector index per embed model, sized to the model's embedding dimension. The default model
+# keeps the original index names so existing data stays in place
+DEFAULT_EMBED_MODEL = "mxbai-embed-large:latest"
+vector_stores = {}
+
+def get_embed_dimension(model_name):
+    # Probed once per model and remembered in models.json
+    dimension = models["dimensions"].get(model_name)
+    if dimension is None:
+        dimension = len(ollama_client.embed(model=model_name, input="dimension probe")["embeddings"][0])
+        models["dimensions"][model_name] = dimension
+        with open('models.json', 'w') as f:
+            json.dump(models, f)
+    return dimension
+
+def vector_store_names(model_name):
+    if model_name == DEFAULT_EMBED_MODEL:
+        return {"index_name": "vector", "keyword_index_name": "keyword", "node_label": "Chunk"}
+    suffix = re.sub(r'\W+', '_', model_name).strip('_')
+    return {"index_name": f"vector_{suffix}", "keyword_index_name": f"keyword_{suffix}", "node_label": f"Chunk_{suffix}"}
+
+# Local stores stay open across settings changes, like the embedding caches, so an ingestion that is
+# still running never shares a directory with a second instance
+local_stores = {}
+
+def local_vector_store(model_name):
+    store = local_stores.get(model_name)
+    if store is None:
+        path = os.path.join("vector_index", hashlib.sha1(model_name.encode()).hexdigest()[:16])
+        store = LocalVectorStore(path, get_embed_dimension(model_name), nprobe=settings["ivf_nprobe"])
+        local_stores[model_name] = store
+    store.nprobe = settings["ivf_nprobe"]
+    return store
+
+def use_vector_store(model_name):
+    global vector_store, vector_index, storage_context
+    store = vector_stores.get(model_name)
+    if store is None and settings["vector_backend"] == "local":
+        store = vector_stores[model_name] = local_vector_store(model_name)
+    if store is None:
+        store = Neo4jVectorStore(settings['database'], settings['password'], settings['uri'], get_embed_dimension(model_name),
+            hybrid_search=True, **vector_store_names(model_name))
+        # The store opens a driver of its own to set up its index; swap it for the shared pool
+        store._driver.close()
+        store._driver = get_neo4j_driver()
+        vector_stores[model_name] = store
+    vector_store = store
+    vector_index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    bump_index_version()
+
+# Chat engines are cached by everything that shapes them, a session only swaps its own memory in
+index_version = 0
+idle_chat_engines = {}
+idle_chat_engines_lock = threading.Lock()
+
+# Retrieval tuning: top-k, the vector/keyword balance of hybrid search and an optional rerank stage
+# that prunes the retrieved chunks before they reach the LLM
+stage_timer = None
+cross_encoders = {}
+
+def retrieval_key():
+    return (settings["similarity_top_k"], settings["hybrid_alpha"], settings["rerank"], settings["rerank_top_n"], settings["cross_encoder_model"])
+
+def build_retriever():
+    if isinstance(vector_store, LocalVectorStore):
+        # The local store weights vector and BM25 scores itself
+        return vector_index.as_retriever(similarity_top_k=settings["similarity_top_k"], vector_store_query_mode="hybrid",
+                                         alpha=settings["hybrid_alpha"])
+    return Neo4jHybridRetriever(vector_store, Settings.embed_model, settings["similarity_top_k"], settings["hybrid_alpha"],
+                                callback_manager=Settings.callback_manager)
+
+def build_rerankers():
+    mode = settings["rerank"]
+    if mode == "cross-encoder":
+        key = (settings["cross_encoder_model"], settings["rerank_top_n"])
+        if key not in cross_encoders:
+            try:
+                # Loaded once and shared by all engines; runs on the CPU so it doesn't compete with Ollama
+                reranker = SentenceTransformerRerank(model=key[0], top_n=key[1], device="cpu")
+                reranker.callback_manager = Settings.callback_manager
+                cross_encoders[key] = reranker
+            except ImportError as e:
+                print(f"Cross-encoder reranking needs sentence-transformers ({e}), using the lexical reranker")
+                mode = "lexical"
+        if mode == "cross-encoder":
+            return [cross_encoders[key]]
+    if mode == "lexical":
+        return [LexicalReranker(top_n=settings["rerank_top_n"], callback_manager=Settings.callback_manager)]
+    return []
+
+def build_chat_engine(memory):
+    # The retrieval chat modes get the tuned retriever; the others build theirs inside llama-index and
+    # only take top-k and the rerank stage
+    if settings["chat_mode"] == "condense_plus_context":
+        return CondensePlusContextChatEngine.from_defaults(retriever=build_retriever(), llm=llm,
+            context_prompt=selected_chat_engine_prompt["value"], memory=memory,
+            node_postprocessors=build_rerankers(), verbose=True)
+    if settings["chat_mode"] == "context":
+        return ContextChatEngine.from_defaults(retriever=build_retriever(), llm=llm, memory=memory,
+            node_postprocessors=build_rerankers())
+    return vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
+        context_prompt=(
+            selected_chat_engine_prompt["value"]
+        ), memory=memory, verbose=True, similarity_top_k=settings["similarity_top_k"],
+        node_postprocessors=build_rerankers()
+    )
+
+def chat_engine_key():
+    return (current_model, settings["chat_mode"], selected_chat_engine_prompt["value"], index_version, retrieval_key())
+
+def set_engine_memory(chat_engine, memory):
+    # Agents (react mode) expose their memory publicly, the other chat engines keep it in _memory
+    if hasattr(chat_engine, "_memory"):
+        chat_engine._memory = memory
+    else:
+        chat_engine.memory = memory
+
+def acquire_chat_engine(key, memory):
+    with idle_chat_engines_lock:
+        # Engines built for an older model, prompt or index are never handed out again
+        for stale_key in [k for k in idle_chat_engines if k != key]:
+            del idle_chat_engines[stale_key]
+        pool = idle_chat_engines.get(key)
+        chat_engine = pool.pop() if pool else None
+    if chat_engine is None:
+        return build_chat_engine(memory)
+    set_engine_memory(chat_engine, memory)
+    return chat_engine
+
+def release_chat_engine(key, chat_engine):
+    if chat_engine is None or key != chat_engine_key():
+        return
+    with idle_chat_engines_lock:
+        pool = idle_chat_engines.setdefault(key, [])
+        if len(pool) < settings["max_sessions"]:
+            pool.append(chat_engine)
+
+# Per-client chat sessions, so concurrent users don't share memory or session files
+def new_memory():
+    # "summary" keeps a rolling summary plus the latest turns, "buffer" only truncates to the token limit
+    if settings["memory_mode"] == "summary":
+        return SummaryChatMemory.from_defaults(token_limit=settings["token_limit"])
+    return ChatMemoryBuffer.from_defaults(token_limit=settings["token_limit"])
+
+class ChatSession:
+    def __init__(self, session_id):
+        self.id = session_id
+        self.session_file = None
+        self.session_updated = False
+        self.memory = new_memory()
+        self.chat_engine = None
+        self.engine_key = None
+        self.last_used = time.time()
+
+    def get_chat_engine(self):
+        key = chat_engine_key()
+        if self.engine_key != key:
+            release_chat_engine(self.engine_key, self.chat_engine)
+            self.chat_engine = acquire_chat_engine(key, self.memory)
+            self.engine_key = key
+        return self.chat_engine
+
+    def reset(self, memory):
+        # Switching chats is a memory swap, the engine itself is kept
+        self.memory = memory
+        if self.chat_engine is not None:
+            set_engine_memory(self.chat_engine, memory)
+
+    def close(self):
+        release_chat_engine(self.engine_key, self.chat_engine)
+        self.chat_engine = None
+        self.engine_key = None
+
+chat_sessions = OrderedDict()
+chat_sessions_lock = threading.Lock()
+
+def get_client_session_id(headers, cookies):
+    # API clients send X-Session-Id, browsers carry the tok_session cookie. None for a new client
+    return headers.get('X-Session-Id') or cookies.get('tok_session') or None
+
+def new_session_id():
+    return secrets.token_hex(16)
+
+def session_cookie(session_id):
+    return dump_cookie('tok_session', session_id, httponly=True, samesite='Lax')
+
+def request_session_id():
+    # A new client gets a random id, issue_session_cookie hands it out with the response
+    session_id = get_client_session_id(request.headers, request.cookies)
+    if session_id is None:
+        session_id = g.setdefault("issued_session_id", new_session_id())
+    return session_id
+
+@app.after_request
+def issue_session_cookie(response):
+    if get_client_session_id(request.headers, request.cookies) is None:
+        response.headers.add('Set-Cookie', session_cookie(g.get("issued_session_id") or new_session_id()))
+    return response
+
+def evict_idle_sessions():
+    # Called with chat_sessions_lock held; chat_sessions is kept in least-recently-used order
+    now = time.time()
+    while chat_sessions:
+        oldest = next(iter(chat_sessions.values()))
+        if len(chat_sessions) <= settings["max_sessions"] and now - oldest.last_used <= settings["session_idle_timeout"]:
+            break
+        _, evicted = chat_sessions.popitem(last=False)
+        evicted.close()
+
+def get_chat_session(session_id=None):
+    if session_id is None:
+        session_id = request_session_id()
+    with chat_sessions_lock:
+        chat = chat_sessions.get(session_id)
+        if chat is not None:
+            chat.last_used = time.time()
+            chat_sessions.move_to_end(session_id)
+            # Idle sessions are also dropped while no new client shows up
+            evict_idle_sessions()
+            return chat
+
+    chat = ChatSession(session_id)
+    with chat_sessions_lock:
+        chat = chat_sessions.setdefault(session_id, chat)
+        chat_sessions.move_to_end(session_id)
+        evict_idle_sessions()
+    return chat
+
+def reset_chat_memories():
+    with chat_sessions_lock:
+        live_sessions = list(chat_sessions.values())
+    for chat in live_sessions:
+        chat.reset(new_memory())
 
 # Functions for session management
-def get_session_number():
-    return len([name for name in os.listdir('prev_msgs') if os.path.isfile(os.path.join('prev_msgs', name))])
+# Sessions are stored as JSON Lines: header records ({"title", "date"}) and one record per turn,
+# so saving a reply is a single append instead of rewriting the whole file
+session_id_lock = threading.Lock()
+last_session_ms = 0
+
+def new_ordered_id():
+    # Time-ordered id: 48-bit millisecond timestamp followed by 64 random bits, like a UUIDv7
+    global last_session_ms
+    with session_id_lock:
+        now_ms = max(time.time_ns() // 1_000_000, last_session_ms + 1)
+        last_session_ms = now_ms
+    return f"{now_ms:012x}{secrets.token_hex(8)}"
 
 def start_new_session():
-    session_num = get_session_number() + 1
-    session_filename = os.path.join("prev_msgs", f"session_{session_num}.json")
-    with open(session_filename, "w") as session_file:
-        json.dump([], session_file)
+    # Sharded by month so no single directory grows with the whole history
+    shard = datetime.now().strftime("%Y-%m")
+    create_directory_if_not_exists(os.path.join("prev_msgs", shard))
+    session_filename = os.path.join("prev_msgs", shard, f"session_{new_ordered_id()}.jsonl")
+    # Exclusive create, an existing session is never overwritten
+    open(session_filename, "x").close()
+    add_to_catalog(session_filename)
     return session_filename
 
-current_session = None
-current_session_updated = False
+session_logs = OrderedDict()
+session_logs_lock = threading.Lock()
+
+def sync_session_log(log):
+    log["file"].flush()
+    os.fsync(log["file"].fileno())
+    log["pending"] = 0
+    log["synced"] = time.time()
+
+def append_to_session(session, record):
+    with session_logs_lock:
+        log = session_logs.get(session)
+        if log is None:
+            log = {"file": open(session, "a", encoding="utf-8"), "pending": 0, "synced": time.time()}
+            session_logs[session] = log
+            # Keep a bounded number of open handles
+            while len(session_logs) > settings["max_sessions"]:
+                _, stale = session_logs.popitem(last=False)
+                sync_session_log(stale)
+                stale["file"].close()
+        session_logs.move_to_end(session)
+
+        log["file"].write(json.dumps(record) + "\n")
+        log["file"].flush()
+        log["pending"] += 1
+        # fsync in batches, a crash loses at most the unsynced tail and never corrupts earlier turns
+        if log["pending"] >= settings["session_fsync_every"] or time.time() - log["synced"] >= settings["session_fsync_interval"]:
+            sync_session_log(log)
+
+def close_session_logs():
+    with session_logs_lock:
+        while session_logs:
+            _, log = session_logs.popitem()
+            sync_session_log(log)
+            log["file"].close()
+
+atexit.register(close_session_logs)
+
+def save_to_session(session, data, refresh_date=False):
+    if refresh_date: append_to_session(session, {"date": str(datetime.now())})
+    append_to_session(session, data)
+    update_catalog(session, data)
+
+def read_session_records(session):
+    # Returns the header, the turns and the latest memory summary record, if any
+    if session.endswith(".json"):
+        with open(session, 'r') as file:
+            session_data = json.load(file)
+        return (session_data[0] if session_data else {}), session_data[1:], None
+
+    header, turns, summary = {}, [], None
+    with open(session, 'r', encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn last line from a crash mid-append
+                continue
+            if "query" in record:
+                turns.append(record)
+            elif "summary" in record:
+                summary = record
+            else:
+                header.update(record)
+    return header, turns, summary
+
+def read_session(session):
+    # Returns [header, turn, turn, ...], the shape the UI expects
+    header, turns, _ = read_session_records(session)
+    return [header] + turns if header else []
+
+def migrate_session_files():
+    # One-time conversion of the old session_N.json files to JSON Lines
+    for filename in os.listdir("prev_msgs"):
+        if not filename.endswith(".json"):
+            continue
+        old_path = os.path.join("prev_msgs", filename)
+        new_path = old_path + "l"
+        try:
+            with open(old_path, 'r') as file:
+                session_data = json.load(file)
+            with open(new_path + ".tmp", 'w', encoding="utf-8") as file:
+                for record in session_data:
+                    file.write(json.dumps(record) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(new_path + ".tmp", new_path)
+            os.remove(old_path)
+        except Exception as e:
+            print(f"Could not migrate {filename}, it will be read in the old format: {e}")
+
+# Scheduler in front of Ollama: a bounded number of requests run at once, interactive turns go before
+# background work (titles, embedding), and waiting sessions are served round-robin
+class SchedulerBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Too many queued requests, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class LLMScheduler:
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.running = 0
+        # priority -> session id -> tickets, sessions in round-robin order
+        self.waiting = {self.INTERACTIVE: OrderedDict(), self.BACKGROUND: OrderedDict()}
+        # ticket -> (loop, future, priority, session id, start) of the requests waiting on an event loop
+        self.async_waiters = {}
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.completed = 0
+        self.hold_total = 0.0
+
+    def queued(self, priority):
+        return sum(len(tickets) for tickets in self.waiting[priority].values())
+
+    def next_ticket(self):
+        for priority in (self.INTERACTIVE, self.BACKGROUND):
+            if self.waiting[priority]:
+                return next(iter(self.waiting[priority].values()))[0]
+        return None
+
+    def retry_after(self):
+        # Rough time until a new request would be admitted, from the average time a slot is held
+        average_hold = self.hold_total / self.completed if self.completed else 5.0
+        backlog = self.queued(self.INTERACTIVE) + 1
+        return max(1, math.ceil(average_hold * backlog / settings["llm_max_concurrency"]))
+
+    def remove(self, priority, session_id, ticket):
+        tickets = self.waiting[priority][session_id]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[priority][session_id]
+        else:
+            # The session goes to the back of the line for its next request
+            self.waiting[priority].move_to_end(session_id)
+
+    def enqueue(self, session_id, priority):
+        # Interactive requests fail fast when the queue is full or the wait is too long; background work waits
+        if priority == self.INTERACTIVE and self.queued(self.INTERACTIVE) >= settings["llm_max_queue"]:
+            self.rejected += 1
+            raise SchedulerBusy(self.retry_after())
+        ticket = object()
+        self.waiting[priority].setdefault(session_id, deque()).append(ticket)
+        return ticket
+
+    def can_admit(self, ticket):
+        return self.running < settings["llm_max_concurrency"] and self.next_ticket() is ticket
+
+    def admit(self, priority, session_id, ticket, start):
+        self.remove(priority, session_id, ticket)
+        self.running += 1
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return time.monotonic()
+
+    def wake(self):
+        # Threads waiting in acquire admit themselves once woken. Requests waiting on an event loop are
+        # admitted here, for as long as slots are free and one of them is next in line
+        self.condition.notify_all()
+        while self.running < settings["llm_max_concurrency"] and self.next_ticket() in self.async_waiters:
+            ticket = self.next_ticket()
+            loop, future, priority, session_id, start = self.async_waiters.pop(ticket)
+            loop.call_soon_threadsafe(future.set_result, self.admit(priority, session_id, ticket, start))
+
+    def acquire(self, session_id, priority=INTERACTIVE):
+        start = time.monotonic()
+        with self.condition:
+            ticket = self.enqueue(session_id, priority)
+            deadline = start + settings["llm_queue_timeout"] if priority == self.INTERACTIVE else None
+            while not self.can_admit(ticket):
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    self.remove(priority, session_id, ticket)
+                    self.rejected += 1
+                    self.wake()
+                    raise SchedulerBusy(self.retry_after())
+                self.condition.wait(remaining)
+            started = self.admit(priority, session_id, ticket, start)
+            # Another slot may still be free for the next ticket in line
+            self.wake()
+        return started
+
+    async def acquire_async(self, session_id, priority=INTERACTIVE):
+        # Same queue as acquire, but the wait is a future resolved by wake, so a queued request holds no
+        # thread. A cancelled wait gives up its place in line, or its slot if it was admitted meanwhile
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.condition:
+            ticket = self.enqueue(session_id, priority)
+            if self.can_admit(ticket):
+                started = self.admit(priority, session_id, ticket, start)
+                self.wake()
+                return started
+            self.async_waiters[ticket] = (loop, future, priority, session_id, start)
+        timeout = settings["llm_queue_timeout"] if priority == self.INTERACTIVE else None
+        try:
+            await asyncio.wait([future], timeout=timeout)
+        except asyncio.CancelledError:
+            with self.condition:
+                if self.async_waiters.pop(ticket, None) is not None:
+                    self.remove(priority, session_id, ticket)
+                    self.wake()
+                    raise
+            future.add_done_callback(lambda admitted: self.release(admitted.result()))
+            raise
+        with self.condition:
+            if self.async_waiters.pop(ticket, None) is not None:
+                self.remove(priority, session_id, ticket)
+                self.rejected += 1
+                self.wake()
+                raise SchedulerBusy(self.retry_after())
+        # Admitted, possibly just as the timeout fired; the result is set by a callback on this loop
+        return await future
+
+    def release(self, started):
+        with self.condition:
+            self.running -= 1
+            self.completed += 1
+            self.hold_total += time.monotonic() - started
+            self.wake()
+
+    @contextmanager
+    def slot(self, session_id, priority=INTERACTIVE):
+        started = self.acquire(session_id, priority)
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "max_concurrency": settings["llm_max_concurrency"],
+                "running": self.running,
+                "queued_interactive": self.queued(self.INTERACTIVE),
+                "queued_background": self.queued(self.BACKGROUND),
+                "waiting_sessions": len(self.waiting[self.INTERACTIVE]) + len(self.waiting[self.BACKGROUND]),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "wait_seconds_avg": self.wait_total / self.admitted if self.admitted else 0.0,
+                "wait_seconds_max": self.wait_max,
+                "hold_seconds_avg": self.hold_total / self.completed if self.completed else 0.0
+            }
+
+llm_scheduler = LLMScheduler()
+
+def busy_response(e):
+    return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {"Retry-After": str(e.retry_after)}
 
-def save_to_session(session, data):
-    global current_session_updated
-    with open(session, "r+") as session_file:
-        session_data = json.load(session_file)
-        if not current_session_updated: session_data[0]["date"] = str(datetime.now())
-        session_data.append(data)
-        session_file.seek(0)
-        json.dump(session_data, session_file)
-        session_file.truncate()
+# Session titles are generated in the background so the response stream closes right after the answer
+title_queue = queue.Queue()
+
+def placeholder_title(query, length=50):
+    query = " ".join(query.split())
+    return query if len(query) <= length else query[:length - 3].rstrip() + "..."
+
+def title_worker():
+    while True:
+        session, query = title_queue.get()
+        try:
+            prompt = f'`{query}`\n\nGenerate a short and crisp title pertaining to the above query, in quotes'
+            with llm_scheduler.slot("titles", LLMScheduler.BACKGROUND):
+                title_response = llm.complete(prompt).text.strip()
+            title = title_response.split('"')[1] if title_response.count('"') >= 2 else title_response
+            save_to_session(session, {"title": title})
+        except Exception as e:
+            print(f"Error generating title for {session}: {e}")
+            traceback.print_exc()
+        finally:
+            title_queue.task_done()
+
+# Summary memory: once enough turns are older than the verbatim window, they are folded into the
+# session's summary in the background. Each new summary is appended to the session log, so resuming
+# a chat loads the summary and the turns after it instead of replaying the whole history
+summary_queue = queue.Queue()
+
+def summarize_turns(summary, messages):
+    transcript = "\n".join(f"{message.role.value}: {message.content}" for message in messages)
+    prompt = (f"Summary of the conversation so far:\n{summary or '(none)'}\n\nNew messages:\n{transcript}\n\n"
+              "Write an updated summary of the whole conversation in a few sentences. Keep names, facts, "
+              "numbers and decisions the user may refer back to.")
+    with llm_scheduler.slot("summaries", LLMScheduler.BACKGROUND):
+        return llm.complete(prompt).text.strip()
+
+def summarize_session(session, memory):
+    messages = memory.turns_to_fold(settings["memory_recent_turns"], settings["memory_summarize_every"])
+    if messages and memory.fold(messages, summarize_turns(memory.summary, messages)) and session:
+        append_to_session(session, {"summary": memory.summary, "summarized_turns": memory.summarized_turns})
+
+def summary_worker():
+    while True:
+        session, memory = summary_queue.get()
+        try:
+            summarize_session(session, memory)
+        except Exception as e:
+            print(f"Error summarizing {session}: {e}")
+            traceback.print_exc()
+        finally:
+            summary_queue.task_done()
+
+def load_session_memory(turns, summary):
+    memory = new_memory()
+    if isinstance(memory, SummaryChatMemory):
+        if summary:
+            memory.summary = summary["summary"]
+            replay = turns[summary["summarized_turns"]:]
+        else:
+            replay = turns[-settings["history_replay_turns"]:]
+        memory.summarized_turns = len(turns) - len(replay)
+    else:
+        # Only the tail can fit in the memory's token limit anyway
+        replay = turns[-settings["history_replay_turns"]:]
+    for data in replay:
+        memory.put(ChatMessage.from_str(content=data['query']))
+        memory.put(ChatMessage.from_str(content=data['response'], role='assistant'))
+    return memory
+
+# Catalog of saved sessions, so listing history doesn't open every session file
+catalog = None
+catalog_lock = threading.Lock()
+
+def init_catalog():
+    global catalog
+    catalog = sqlite3.connect(os.path.join("prev_msgs", "catalog.db"), check_same_thread=False)
+    catalog.execute("PRAGMA journal_mode=WAL")
+    catalog.execute("""CREATE TABLE IF NOT EXISTS sessions (
+        filename TEXT PRIMARY KEY,
+        title TEXT,
+        created TEXT,
+        updated TEXT,
+        message_count INTEGER NOT NULL DEFAULT 0
+    )""")
+    catalog.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+    catalog.commit()
+
+    # Backfill from the session files the first time the catalog is created
+    if catalog.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] == 0:
+        for root, _, filenames in os.walk("prev_msgs"):
+            for filename in filenames:
+                if filename.endswith(".json") or filename.endswith(".jsonl"):
+                    session = os.path.join(root, filename)
+                    session_data = read_session(session)
+                    if session_data:
+                        header = session_data[0]
+                        catalog.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                            (catalog_key(session), header.get("title"), header.get("date"), header.get("date"), len(session_data) - 1))
+        catalog.commit()
+
+def catalog_key(session):
+    return os.path.relpath(session, "prev_msgs").replace(os.sep, "/")
+
+def add_to_catalog(session):
+    now = str(datetime.now())
+    with catalog_lock:
+        catalog.execute("INSERT OR IGNORE INTO sessions (filename, created, updated) VALUES (?, ?, ?)", (catalog_key(session), now, now))
+        catalog.commit()
+
+def update_catalog(session, data):
+    key = catalog_key(session)
+    with catalog_lock:
+        if "title" in data:
+            catalog.execute("UPDATE sessions SET title = ? WHERE filename = ?", (data["title"], key))
+        if "query" in data:
+            catalog.execute("UPDATE sessions SET message_count = message_count + 1, updated = ? WHERE filename = ?", (str(datetime.now()), key))
+        elif "date" in data:
+            catalog.execute("UPDATE sessions SET updated = ? WHERE filename = ?", (data["date"], key))
+        catalog.commit()
+
+def find_in_catalog(filename):
+    with catalog_lock:
+        return catalog.execute("SELECT filename FROM sessions WHERE filename = ?", (filename,)).fetchone() is not None
+
+# Document ingestion: files are parsed in a process pool, chunks are embedded in concurrent
+# batches through Ollama's /api/embed, and nodes are written to the vector store in bulk
+def parse_file(path, file_key, metadata):
+    # Runs in the ingestion worker processes, which don't go through startup
+    from backends import SimpleDirectoryReader
+    meta = lambda filename: {"file_name": file_key, **metadata}
+    return SimpleDirectoryReader(input_files=[path], file_metadata=meta).load_data()
+
+def embed_batch(nodes):
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    def compute(missing):
+        with llm_scheduler.slot("ingest", LLMScheduler.BACKGROUND), ollama_seconds.time("embed", errors=ollama_errors):
+            return ollama_client.embed(model=current_embed_model, input=missing)["embeddings"]
+    embeddings = embedding_cache(current_embed_model).cached("text", texts, compute)
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+
+def embed_nodes(nodes):
+    batch_size = settings["embed_batch_size"]
+    batches = [nodes[i:i + batch_size] for i in range(0, len(nodes), batch_size)]
+    with ThreadPoolExecutor(max_workers=settings["embed_concurrency"]) as executor:
+        # list() surfaces the first failed batch as an exception
+        list(executor.map(embed_batch, batches))
+
+def write_nodes(nodes):
+    batch_size = settings["insert_batch_size"]
+    for i in range(0, len(nodes), batch_size):
+        if isinstance(vector_store, LocalVectorStore):
+            vector_store.add(nodes[i:i + batch_size])
+        else:
+            with neo4j_seconds.time("write", errors=neo4j_errors):
+                vector_store.add(nodes[i:i + batch_size])
+
+def delete_nodes(node_ids):
+    if node_ids and isinstance(vector_store, LocalVectorStore):
+        vector_store.delete_nodes(node_ids)
+    elif node_ids:
+        with neo4j_seconds.time("delete", errors=neo4j_errors):
+            vector_store.database_query(f"MATCH (n:`{vector_store.node_label}`) WHERE n.id IN $ids DETACH DELETE n", params={"ids": list(node_ids)})
+
+# Manifest of content hashes per uploaded file and per chunk, so re-uploads only embed what changed.
+# Entries are kept per store and embed model, a file already in Neo4j is still ingested into a local index
+manifest = None
+manifest_lock = threading.Lock()
+
+def neo4j_store_key():
+    return f"neo4j:{settings['uri']}/{settings['database']}"
+
+def manifest_store():
+    if isinstance(vector_store, LocalVectorStore):
+        return f"local:{os.path.abspath(vector_store.path)}"
+    return neo4j_store_key()
+
+def init_manifest():
+    global manifest
+    manifest = sqlite3.connect("index_manifest.db", check_same_thread=False)
+    manifest.execute("PRAGMA journal_mode=WAL")
+    # Manifests from before the store column only described the Neo4j database of the current settings
+    legacy = [row[1] for row in manifest.execute("PRAGMA table_info(files)")]
+    if legacy and "store" not in legacy:
+        manifest.execute("ALTER TABLE files RENAME TO files_legacy")
+        manifest.execute("ALTER TABLE chunks RENAME TO chunks_legacy")
+    manifest.execute("""CREATE TABLE IF NOT EXISTS files (
+        file_key TEXT NOT NULL,
+        store TEXT NOT NULL,
+        embed_model TEXT NOT NULL,
+        file_hash TEXT NOT NULL,
+        updated TEXT,
+        PRIMARY KEY (file_key, store, embed_model)
+    )""")
+    manifest.execute("""CREATE TABLE IF NOT EXISTS chunks (
+        node_id TEXT NOT NULL,
+        file_key TEXT NOT NULL,
+        store TEXT NOT NULL,
+        embed_model TEXT NOT NULL,
+        chunk_hash TEXT NOT NULL,
+        PRIMARY KEY (node_id, store, embed_model)
+    )""")
+    if legacy and "store" not in legacy:
+        store = neo4j_store_key()
+        manifest.execute("INSERT INTO files SELECT file_key, ?, embed_model, file_hash, updated FROM files_legacy", (store,))
+        manifest.execute("INSERT INTO chunks SELECT node_id, file_key, ?, embed_model, chunk_hash FROM chunks_legacy", (store,))
+        manifest.execute("DROP TABLE files_legacy")
+        manifest.execute("DROP TABLE chunks_legacy")
+    manifest.execute("CREATE INDEX IF NOT EXISTS chunks_file ON chunks (file_key, store, embed_model)")
+    manifest.commit()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def manifest_file_hash(file_key):
+    with manifest_lock:
+        row = manifest.execute("SELECT file_hash FROM files WHERE file_key = ? AND store = ? AND embed_model = ?",
+            (file_key, manifest_store(), current_embed_model)).fetchone()
+    return row[0] if row else None
+
+def manifest_node_ids(file_key):
+    with manifest_lock:
+        return {row[0] for row in manifest.execute("SELECT node_id FROM chunks WHERE file_key = ? AND store = ? AND embed_model = ?",
+            (file_key, manifest_store(), current_embed_model))}
+
+def update_manifest(file_key, file_hash, chunk_hashes):
+    store = manifest_store()
+    with manifest_lock:
+        manifest.execute("DELETE FROM chunks WHERE file_key = ? AND store = ? AND embed_model = ?", (file_key, store, current_embed_model))
+        manifest.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)",
+            [(node_id, file_key, store, current_embed_model, chunk_hash) for node_id, chunk_hash in chunk_hashes.items()])
+        manifest.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (file_key, store, current_embed_model, file_hash, str(datetime.now())))
+        manifest.commit()
+
+def windows(iterable, size):
+    iterator = iter(iterable)
+    while window := list(islice(iterator, max(1, size))):
+        yield window
+
+def ingest_files(job, on_progress=None):
+    # Files are processed in groups of ingest_workers; a group is only marked done once its
+    # chunks are written, which is what makes jobs resumable at file granularity
+    files_dir = os.path.join(job["dir"], "files")
+    pending = [f for f in job["files"] if f not in job["files_done"]]
+    group_size = max(1, settings["ingest_workers"])
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=group_size) as executor:
+        for i in range(0, len(pending), group_size):
+            group = pending[i:i + group_size]
+            # Files whose content hash is unchanged since the last upload are skipped entirely
+            file_hashes = {f: hash_file(os.path.join(files_dir, f)) for f in group}
+            changed = [f for f in group if manifest_file_hash(f) != file_hashes[f]]
+            job["files_skipped"] += len(group) - len(changed)
+            ingested_files.inc("skipped", amount=len(group) - len(changed))
+
+            futures = {f: executor.submit(parse_file, os.path.join(files_dir, f), f, job["metadata"]) for f in changed}
+            file_updates = []
+
+            def group_nodes():
+                # Chunks are produced one file and one document at a time, and each result is
+                # dropped once consumed, so the group is never held in memory as a whole
+                for f in changed:
+                    future = futures.pop(f)
+                    try:
+                        documents = future.result()
+                    except Exception as e:
+                        job["errors"].append({"file": f, "error": str(e)})
+                        ingested_files.inc("failed")
+                        continue
+                    job["documents"] += len(documents)
+                    ingested_documents.inc(amount=len(documents))
+
+                    # Node ids derive from the file and chunk content, so unchanged chunks keep their id
+                    chunk_hashes = {}
+                    old_ids = manifest_node_ids(f)
+                    while documents:
+                        for node in Settings.node_parser.get_nodes_from_documents([documents.pop(0)]):
+                            chunk_hash = hash_text(node.get_content(metadata_mode=MetadataMode.EMBED))
+                            node.id_ = hash_text(f"{f}\0{chunk_hash}")[:32]
+                            if node.id_ in chunk_hashes:
+                                continue
+                            chunk_hashes[node.id_] = chunk_hash
+                            if node.id_ in old_ids:
+                                job["chunks_skipped"] += 1
+                                ingested_chunks.inc("skipped")
+                            else:
+                                yield node
+                    stale_ids = old_ids - chunk_hashes.keys()
+                    file_updates.append((f, file_hashes[f], chunk_hashes, stale_ids))
+
+            # Embedding and writing happen in windows of ingest_window chunks, which bounds peak
+            # memory however large the upload is
+            written = 0
+            for window in windows(group_nodes(), settings["ingest_window"]):
+                embed_nodes(window)
+                job["chunks_embedded"] += len(window)
+                ingested_chunks.inc("embedded", amount=len(window))
+                write_nodes(window)
+                job["chunks_written"] += len(window)
+                ingested_chunks.inc("written", amount=len(window))
+                written += len(window)
+            job["files_parsed"] += len(changed)
+            ingested_files.inc("parsed", amount=len(changed))
+
+            # Replace what the previous version of each changed file left behind
+            deleted = 0
+            for f, file_hash, chunk_hashes, stale_ids in file_updates:
+                delete_nodes(stale_ids)
+                deleted += len(stale_ids)
+                update_manifest(f, file_hash, chunk_hashes)
+            job["chunks_deleted"] += deleted
+            ingested_chunks.inc("deleted", amount=deleted)
+
+            job["files_done"].extend(group)
+            if written or deleted:
+                bump_index_version()
+            if on_progress:
+                on_progress(job)
+
+    elapsed = time.perf_counter() - start
+    job["stats"] = {
+        "seconds": elapsed,
+        "docs_per_second": job["documents"] / elapsed if elapsed else 0.0,
+        "chunks_per_second": job["chunks_written"] / elapsed if elapsed else 0.0
+    }
+    print(f"Ingested {job['documents']} documents ({job['chunks_written']} chunks) in {elapsed:.2f}s: "
+          f"{job['stats']['docs_per_second']:.2f} docs/s, {job['stats']['chunks_per_second']:.2f} chunks/s")
+    return job
+
+# Ingestion runs as background jobs persisted under ingest_jobs/<id>, so uploads return right away
+# and unfinished jobs resume after a restart
+ingest_queue = queue.Queue()
+ingest_jobs = {}
+ingest_jobs_lock = threading.Lock()
+
+def safe_relative_path(filename):
+    path = os.path.normpath(filename).lstrip("\\/")
+    if path.startswith(".."):
+        path = os.path.basename(path)
+    return path
+
+def save_ingest_job(job):
+    job["updated"] = str(datetime.now())
+    job_file = os.path.join(job["dir"], "job.json")
+    with ingest_jobs_lock:
+        with open(job_file + ".tmp", 'w') as f:
+            json.dump(job, f)
+        os.replace(job_file + ".tmp", job_file)
+
+def create_ingest_job(files, metadata):
+    job_id = new_ordered_id()
+    job_dir = os.path.join("ingest_jobs", job_id)
+    saved = []
+    for file in files:
+        relative_path = safe_relative_path(file.filename)  # This will include the relative folder structure
+        save_path = os.path.join(job_dir, "files", relative_path)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        staged = getattr(file.stream, "name", None)
+        if isinstance(staged, str) and os.path.isfile(staged):
+            # Already streamed to disk by UploadRequest, so moving it is enough
+            file.stream.close()
+            os.replace(staged, save_path)
+        else:
+            file.save(save_path)
+        saved.append(relative_path)
+
+    job = {
+        "id": job_id,
+        "dir": job_dir,
+        "status": "queued",
+        "created": str(datetime.now()),
+        "metadata": metadata,
+        "files": saved,
+        "files_done": [],
+        "files_parsed": 0,
+        "files_skipped": 0,
+        "documents": 0,
+        "chunks_embedded": 0,
+        "chunks_written": 0,
+        "chunks_skipped": 0,
+        "chunks_deleted": 0,
+        "errors": []
+    }
+    save_ingest_job(job)
+    ingest_jobs[job_id] = job
+    ingest_queue.put(job)
+    return job
+
+def ingest_worker():
+    while True:
+        job = ingest_queue.get()
+        try:
+            job["status"] = "running"
+            save_ingest_job(job)
+            ingest_files(job, on_progress=save_ingest_job)
+            if job["documents"] or job["files_skipped"]:
+                job["status"] = "completed"
+            else:
+                job["status"] = "failed"
+                job["errors"].append({"error": "No valid documents found"})
+            shutil.rmtree(os.path.join(job["dir"], "files"), ignore_errors=True)
+        except Exception as e:
+            print(f"Ingestion job {job['id']} failed: {e}")
+            traceback.print_exc()
+            job["status"] = "failed"
+            job["errors"].append({"error": str(e)})
+        finally:
+            save_ingest_job(job)
+            ingest_queue.task_done()
+
+def ingest_job_status(job):
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "created": job["created"],
+        "updated": job.get("updated"),
+        "files": len(job["files"]),
+        "files_done": len(job["files_done"]),
+        "files_parsed": job["files_parsed"],
+        "files_skipped": job.get("files_skipped", 0),
+        "documents": job["documents"],
+        "chunks_embedded": job["chunks_embedded"],
+        "chunks_written": job["chunks_written"],
+        "chunks_skipped": job.get("chunks_skipped", 0),
+        "chunks_deleted": job.get("chunks_deleted", 0),
+        "errors": job["errors"],
+        "stats": job.get("stats")
+    }
+
+def resume_ingest_jobs():
+    create_directory_if_not_exists("ingest_jobs")
+    # Uploads interrupted by a restart never became jobs
+    shutil.rmtree("uploads", ignore_errors=True)
+    for job_id in sorted(os.listdir("ingest_jobs")):
+        try:
+            with open(os.path.join("ingest_jobs", job_id, "job.json"), 'r') as f:
+                job = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+        ingest_jobs[job_id] = job
+        if job["status"] in ("queued", "running"):
+            print(f"Resuming ingestion job {job_id} ({len(job['files_done'])}/{len(job['files'])} files done)")
+            ingest_queue.put(job)
 
 # Serve the Swagger YAML file directly
 @app.route('/swagger.yaml')
 def swagger_yaml():
     return send_from_directory('web/build/static', 'swagger.yaml')
 
+# Routes that only read local state work while the backends are starting
+STARTUP_ROUTES = {"get_chat_history", "readiness", "scheduler_stats", "list_pull_jobs", "get_pull_job"}
+
+def startup_response():
+    return {"error": "The server is still starting, try again shortly", "components": startup_steps}
+
+@app.before_request
+def require_startup():
+    if request.path.startswith('/api/') and request.blueprint is None and request.endpoint not in STARTUP_ROUTES \
+            and not startup_done.is_set():
+        return jsonify(startup_response()), 503, {"Retry-After": "2"}
+
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    ready = startup_done.is_set() and all(step["state"] == "ready" for step in startup_steps.values())
+    return jsonify({"ready": ready, "components": startup_steps,
+                    "listening_after": startup_times["listening"], "ready_after": startup_times["ready"]}), 200 if ready else 503
+
+# Query handling shared by the WSGI route and the async ASGI path
+def prepare_query(chat, data):
+    # Returns the state of the turn, or an (error, status) pair
+    query = data.get('query')
+    use_chat_engine = data.get('useQueryEngine', False)
+    if query is None:
+        return None, ("Query parameter missing", 400)
+
+    chat_engine = chat.get_chat_engine()
+    if use_chat_engine and chat_engine is None:
+        return None, ("Query engine not initialized", 500)
+    if not use_chat_engine and llm is None:
+        return None, ("LLM not initialized", 500)
+
+    cache_key = response_cache_key(use_chat_engine, chat.memory, query) if settings["response_cache"] else None
+    cached_answer = response_cache.get(*cache_key) if cache_key else None
+
+    if not use_chat_engine:
+        query += selected_LLM_prompt["value"]
+    # A chat engine records the question itself, a cached answer never reaches it
+    if not use_chat_engine or cached_answer is not None:
+        chat.memory.put(ChatMessage.from_str(content=query))
+    return {"chat": chat, "query": query, "title_query": data.get('query'), "use_chat_engine": use_chat_engine,
+            "chat_engine": chat_engine, "cache_key": cache_key, "cached_answer": cached_answer}, None
+
+def prompt_messages(memory):
+    # Bounded by the token limit; a question that doesn't fit on its own is still sent
+    return memory.get() or memory.get_all()[-1:]
+
+def finish_query(turn, bot_message):
+    # Store the complete message
+    chat = turn["chat"]
+    data_to_save = {"query": turn["query"], "response": bot_message}
+
+    if chat.session_file is None:
+        chat.session_file = start_new_session()
+        # Placeholder title until the background worker has generated one
+        title = {"title": placeholder_title(turn["title_query"]), "date": str(datetime.now())}
+        chat.session_updated = True
+        save_to_session(chat.session_file, title)
+        title_queue.put((chat.session_file, turn["query"]))
+
+    # The chat engine records its own answers, replayed and plain LLM answers are recorded here
+    if not turn["use_chat_engine"] or turn["cached_answer"] is not None:
+        chat.memory.put(ChatMessage.from_str(content=bot_message, role='assistant'))
+    if turn["cache_key"] and turn["cached_answer"] is None:
+        response_cache.put(*turn["cache_key"], bot_message)
+
+    save_to_session(chat.session_file, data_to_save, refresh_date=not chat.session_updated)
+    # A resumed session gets its date refreshed once, on the first new turn
+    chat.session_updated = True
+    if isinstance(chat.memory, SummaryChatMemory):
+        summary_queue.put((chat.session_file, chat.memory))
+
+def record_query_timing(trace):
+    # One JSON line per turn, so latency can be broken down per model from the logs, and the same in /metrics
+    timings = trace.timings()
+    print(json.dumps({"event": "query_timing", **timings}))
+    if not trace.cached:
+        if timings["condense"]:
+            ollama_seconds.observe(timings["condense"], "condense")
+        ollama_seconds.observe(timings["total"] - trace.setup, "chat")
+        if timings["first_token"] is not None:
+            query_first_token_seconds.observe(timings["first_token"], trace.model)
+        query_tokens.inc(trace.model, amount=timings["tokens"])
+        if timings["tokens_per_second"]:
+            query_tokens_per_second.observe(timings["tokens_per_second"], trace.model)
+    return timings
+
+def wants_sse(headers):
+    return "text/event-stream" in headers.get('Accept', '')
+
 @app.route('/api/query', methods=['POST'])
 def query():
+    slot_started = None
     try:
-        global current_session
-        global memory
-        global chat_engine
-        global llm
-        global selected_LLM_prompt
-        cur_session = current_session
-        data = request.json
-        query = data.get('query')
-        use_chat_engine = data.get('useQueryEngine', False)
-        bot_message = ""
-        if query is None:
-            return jsonify({"error": "Query parameter missing"}), 400
-
-        # Start the appropriate engine
-        if use_chat_engine:
-            if chat_engine is None:
-                return jsonify({"error": "Query engine not initialized"}), 500
-            memory.put(ChatMessage.from_str(content=query))
-            response_generator = chat_engine.stream_chat(query).response_gen
-        else:
-            if llm is None:
-                return jsonify({"error": "LLM not initialized"}), 500
-            query += selected_LLM_prompt["value"]
-            memory.put(ChatMessage.from_str(content=query))
-            response_generator = llm.stream_chat(memory.get_all())
+        # The slot covers the whole turn, condensing the question included, and is freed when the stream ends
+        chat = get_chat_session()
+        trace = QueryTrace(current_model)
+        with trace.span("queue"):
+            slot_started = llm_scheduler.acquire(chat.id)
+        # Condensing, retrieval and prompt building happen in this context; the answer streams later
+        trace_token = current_trace.set(trace)
+        try:
+            turn, error = prepare_query(chat, request.json)
+            if error:
+                llm_scheduler.release(slot_started)
+                return jsonify({"error": error[0]}), error[1]
+
+            # Start the appropriate engine
+            if turn["cached_answer"] is not None:
+                trace.cached = True
+                response_generator = replay_response(turn["cached_answer"])
+            elif turn["use_chat_engine"]:
+                response_generator = turn["chat_engine"].stream_chat(turn["query"]).response_gen
+            else:
+                response_generator = (res.delta for res in llm.stream_chat(prompt_messages(turn["chat"].memory)))
+        finally:
+            current_trace.reset(trace_token)
+        trace.setup_done()
+
+        # The bundled UI reads plain text; clients asking for event-stream get one SSE event per token
+        # and a timing event at the end
+        use_sse = wants_sse(request.headers)
 
         def generate_response():
-            nonlocal bot_message
-            nonlocal cur_session
-            global current_session
-            global current_session_updated
-            nonlocal use_chat_engine
-
+            bot_message = ""
+            streams_active.inc()
             try:
                 for res in response_generator:
-                    if not use_chat_engine: 
-                        res = res.delta
-                    yield res
+                    # The final chunk of a stream carries no text, only the done flag
+                    if not res:
+                        continue
+                    trace.token()
+                    yield sse_event(res) if use_sse else res
                     bot_message += res
-                # Store the complete message
-                data_to_save = {"query": query, "response": bot_message}
-
-                if cur_session is None:
-                    current_session = start_new_session()
-                    cur_session = current_session
-                    # Generate title for the session
-                    prompt = f'`{query}`\n\nGenerate a short and crisp title pertaining to the above query, in quotes'
-                    title_response = llm.complete(prompt).text.strip()
-                    title = {"title": title_response.split('"')[1], "date": str(datetime.now())}
-                    current_session_updated = True
-                    save_to_session(cur_session, title)
-
-                if not use_chat_engine:
-                    memory.put(ChatMessage.from_str(content=bot_message, role='assistant'))
-
-                save_to_session(cur_session, data_to_save)
+                finish_query(turn, bot_message)
+                timings = record_query_timing(trace)
+                if use_sse:
+                    yield sse_event(json.dumps(timings), event="timing")
+                    yield sse_event("", event="done")
 
             except Exception as e:
                 print(f"Error streaming response: {e}")
                 traceback.print_exc()
-                yield "[ERROR] Something went wrong. Please try again later."
-
-        return app.response_class(generate_response(), mimetype='text/plain')
-
+                ollama_errors.inc("chat")
+                message = "[ERROR] Something went wrong. Please try again later."
+                yield sse_event(message, event="error") if use_sse else message
+            finally:
+                streams_active.dec()
+
+        # Runs when the server closes the response, also when the client left before the stream started
+        response = app.response_class(generate_response(), mimetype='text/event-stream' if use_sse else 'text/plain')
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.call_on_close(lambda: llm_scheduler.release(slot_started))
+        return response
+
+    except SchedulerBusy as e:
+        return busy_response(e)
     except Exception as e:
+        if slot_started is not None:
+            llm_scheduler.release(slot_started)
         print(e)
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+# Async serving mode: /api/query runs as a coroutine, so an open stream costs no thread. Plain LLM
+# answers use the llama-index async streaming API; everything else is the Flask app, run on a pool
+# of WSGI_THREADS threads of its own
+WSGI_THREADS = 32
+def sse_event(text, event=None):
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in text.split("\n")]
+    return ("\n".join(lines) + "\n\n").encode()
+
+async def iterate_in_thread(generator):
+    # Each item is pulled on a worker thread, so a blocking generator never holds the event loop
+    done = object()
+    while (item := await asyncio.to_thread(next, generator, done)) is not done:
+        yield item
+
+async def send_json(send, payload, status, extra_headers=()):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"access-control-allow-origin", b"*"), *extra_headers]})
+    await send({"type": "http.response.body", "body": body})
+
+async def wait_for_disconnect(receive):
+    # Once the request body is read, the next message from the server is the disconnect
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def async_query(scope, receive, send):
+    if not startup_done.is_set():
+        await send_json(send, startup_response(), 503, [(b"retry-after", b"2")])
+        return
+
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+
+    slot_started = None
+    # A client that left stops waiting for a slot, or frees the one its stream holds
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    # The WSGI routes issue the session cookie in issue_session_cookie, this route bypasses Flask
+    cookie_headers = []
+    try:
+        headers = Headers([(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope["headers"]])
+        session_id = get_client_session_id(headers, parse_cookie(headers.get('Cookie', '')))
+        if session_id is None:
+            session_id = new_session_id()
+            cookie_headers.append((b"set-cookie", session_cookie(session_id).encode('latin-1')))
+        # Session lookup, cache lookup and history writes touch disk and the embed model, keep them off the loop.
+        # Waiting for a scheduler slot takes no thread, those are left to the admitted streams
+        chat = await asyncio.to_thread(get_chat_session, session_id)
+        trace = QueryTrace(current_model)
+        with trace.span("queue"):
+            admission = asyncio.ensure_future(llm_scheduler.acquire_async(chat.id))
+            await asyncio.wait([admission, disconnected], return_when=asyncio.FIRST_COMPLETED)
+            if not admission.done():
+                admission.cancel()
+                return
+            slot_started = admission.result()
+        # asyncio.to_thread copies the context, so the trace also sees the work done on threads
+        trace_token = current_trace.set(trace)
+        try:
+            turn, error = await asyncio.to_thread(prepare_query, chat, json.loads(body or b"{}"))
+            if error:
+                disconnected.cancel()
+                llm_scheduler.release(slot_started)
+                await send_json(send, {"error": error[0]}, error[1], cookie_headers)
+                return
+
+            if turn["cached_answer"] is not None:
+                trace.cached = True
+                response_generator = None
+            elif turn["use_chat_engine"]:
+                # The chat engine runs sync on worker threads: its astream_chat (llama-index 0.10) records the
+                # answer from a thread running a second event loop, on the Ollama client bound to this one
+                streaming = await asyncio.to_thread(turn["chat_engine"].stream_chat, turn["query"])
+                response_generator = iterate_in_thread(streaming.response_gen)
+            else:
+                response_generator = await llm.astream_chat(prompt_messages(turn["chat"].memory))
+        finally:
+            current_trace.reset(trace_token)
+        trace.setup_done()
+    except SchedulerBusy as e:
+        disconnected.cancel()
+        await send_json(send, {"error": str(e), "retry_after": e.retry_after}, 429,
+                        [(b"retry-after", str(e.retry_after).encode()), *cookie_headers])
+        return
+    except asyncio.CancelledError:
+        disconnected.cancel()
+        if slot_started is not None:
+            llm_scheduler.release(slot_started)
+        raise
+    except Exception as e:
+        disconnected.cancel()
+        if slot_started is not None:
+            llm_scheduler.release(slot_started)
+        print(e)
+        traceback.print_exc()
+        await send_json(send, {"error": str(e)}, 500, cookie_headers)
+        return
+
+    # The bundled UI reads plain text; clients asking for event-stream get one SSE event per token
+    use_sse = wants_sse(headers)
+    content_type = b"text/event-stream" if use_sse else b"text/plain; charset=utf-8"
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(b"content-type", content_type), (b"cache-control", b"no-cache"), (b"access-control-allow-origin", b"*"),
+                            (b"server-timing", trace.server_timing().encode()), *cookie_headers]})
+
+    async def send_text(text, event=None):
+        await send({"type": "http.response.body", "body": sse_event(text, event) if use_sse else text.encode(), "more_body": True})
+
+    bot_message = ""
+    streams_active.inc()
+    try:
+        if response_generator is None:
+            for res in replay_response(turn["cached_answer"]):
+                trace.token()
+                await send_text(res)
+                bot_message += res
+        else:
+            async for res in response_generator:
+                # Like a WSGI stream closed by the server, the turn ends without being recorded
+                if disconnected.done():
+                    await response_generator.aclose()
+                    return
+                if not turn["use_chat_engine"]:
+                    res = res.delta
+                if not res:
+                    continue
+                trace.token()
+                await send_text(res)
+                bot_message += res
+        await asyncio.to_thread(finish_query, turn, bot_message)
+        timings = record_query_timing(trace)
+        if use_sse:
+            await send_text(json.dumps(timings), event="timing")
+            await send_text("", event="done")
+
+    except Exception as e:
+        print(f"Error streaming response: {e}")
+        traceback.print_exc()
+        ollama_errors.inc("chat")
+        await send_text("[ERROR] Something went wrong. Please try again later.", event="error" if use_sse else None)
+    finally:
+        disconnected.cancel()
+        streams_active.dec()
+        llm_scheduler.release(slot_started)
+    await send({"type": "http.response.body", "body": b""})
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    # asgiref runs a WSGI app thread-sensitive, i.e. every request on one shared thread, so a single open
+    # stream (an upload, a pull progress feed) would hold up every other route. Here each request gets a
+    # thread of a pool that asyncio.to_thread and the query streams don't compete for
+    def __init__(self, wsgi_application, workers):
+        super().__init__(wsgi_application)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        await PooledWsgiToAsgiInstance(self.wsgi_application, self.executor)(scope, receive, send)
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        await sync_to_async(self.run_wsgi_app_in_thread, thread_sensitive=False, executor=self.executor)(body)
+
+    def run_wsgi_app_in_thread(self, body):
+        # As asgiref's, but the response is closed when done, which is what ends a request for MetricsMiddleware
+        response = self.wsgi_application(self.build_environ(self.scope, body), self.start_response)
+        try:
+            bytes_sent = 0
+            for output in response:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if self.response_content_length is not None:
+                    output = output[:self.response_content_length - bytes_sent]
+                self.sync_send({"type": "http.response.body", "body": output, "more_body": True})
+                bytes_sent += len(output)
+                if bytes_sent == self.response_content_length:
+                    break
+            if not self.response_started:
+                self.response_started = True
+                self.sync_send(self.response_start)
+            self.sync_send({"type": "http.response.body"})
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+
+flask_asgi = PooledWsgiToAsgi(app, WSGI_THREADS)
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == "/api/query" and scope["method"] == "POST":
+        # Counted here since this route doesn't go through the WSGI middleware
+        start = time.perf_counter()
+        status = []
+
+        async def metered_send(message):
+            if message["type"] == "http.response.start":
+                status.append(str(message["status"]))
+            await send(message)
+        try:
+            await async_query(scope, receive, metered_send)
+        finally:
+            observe_request("query", "POST", status[0] if status else "", time.perf_counter() - start)
+    else:
+        await flask_asgi(scope, receive, send)
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    embedding = {}
+    for model_name, cache in list(embedding_caches.items()):
+        total = cache.hits + cache.misses
+        embedding[model_name] = {"hits": cache.hits, "misses": cache.misses, "hit_rate": cache.hits / total if total else 0.0}
+    return jsonify({"response": response_cache.stats(), "embedding": embedding})
+
+@app.route('/api/stage_times', methods=['GET'])
+def stage_times():
+    return jsonify(stage_timer.stats() if stage_timer else {})
+
+# State read at scrape time, so keeping it current costs nothing in between
+@registry.collector
+def collect_state():
+    with chat_sessions_lock:
+        live_sessions = list(chat_sessions.values())
+    memory_messages = memory_chars = 0
+    for chat in live_sessions:
+        messages = chat.memory.get_all()
+        memory_messages += len(messages)
+        memory_chars += sum(len(message.content or "") for message in messages)
+
+    caches = [({"cache": "response", "model": ""}, response_cache)]
+    caches += [({"cache": "embedding", "model": model_name}, cache) for model_name, cache in list(embedding_caches.items())]
+    scheduler = llm_scheduler.stats()
+    pool = neo4j_pool_usage() if current_neo4j_driver() is not None else {}
+    try:
+        with open("/proc/self/statm") as f:
+            resident_bytes = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        resident_bytes = None
+
+    return [
+        ("tok_sessions", "gauge", "Live chat sessions", [({}, len(live_sessions))]),
+        ("tok_session_memory_messages", "gauge", "Messages held in the memories of live sessions", [({}, memory_messages)]),
+        ("tok_session_memory_chars", "gauge", "Characters held in the memories of live sessions", [({}, memory_chars)]),
+        ("tok_cache_hits_total", "counter", "Cache hits", [(labels, cache.hits) for labels, cache in caches]),
+        ("tok_cache_misses_total", "counter", "Cache misses", [(labels, cache.misses) for labels, cache in caches]),
+        ("tok_cache_hit_ratio", "gauge", "Cache hits over lookups since startup",
+         [(labels, cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0.0) for labels, cache in caches]),
+        ("tok_scheduler_running", "gauge", "LLM requests holding a scheduler slot", [({}, scheduler["running"])]),
+        ("tok_scheduler_queued", "gauge", "LLM requests waiting for a scheduler slot",
+         [({"priority": "interactive"}, scheduler["queued_interactive"]), ({"priority": "background"}, scheduler["queued_background"])]),
+        ("tok_scheduler_rejected_total", "counter", "LLM requests turned away with 429", [({}, scheduler["rejected"])]),
+        ("tok_neo4j_pool_connections", "gauge", "Neo4j pool connections by state",
+         [({"state": "in_use"}, pool.get("in_use")), ({"state": "idle"}, pool.get("idle"))]),
+        ("tok_ingest_queue_jobs", "gauge", "Ingestion jobs waiting to run", [({}, ingest_queue.qsize())]),
+        ("process_resident_memory_bytes", "gauge", "Resident memory of the server process", [({}, resident_bytes)])
+    ]
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return app.response_class(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/scheduler', methods=['GET'])
+def scheduler_stats():
+    return jsonify(llm_scheduler.stats())
+
+@app.route('/api/resident_models', methods=['GET'])
+def resident_models():
+    return jsonify(model_residency.status())
+
+@app.route('/api/neo4j_pool', methods=['GET'])
+def neo4j_pool():
+    return jsonify(neo4j_pool_usage())
+
 @app.route('/api/history', methods=['GET'])
 def get_chat_history():
     session_titles = {
@@ -334,24 +2179,20 @@ def get_chat_history():
         "Last Month": {},
         "Older": {}
     }
-    today = datetime.now().date()
-    last_week = today - timedelta(days=7)
-    last_month = today - timedelta(days=30)
-    for filename in os.listdir("prev_msgs"):
-        if filename.endswith(".json"):
-            with open(os.path.join("prev_msgs", filename), 'r') as file:
-                session_data = json.load(file)
-                if session_data:
-                    session_date = datetime.strptime(session_data[0].get('date'), "%Y-%m-%d %H:%M:%S.%f").date()
-                    session_title = session_data[0].get('title')
-                    if session_date == today:
-                        session_titles["Today"][session_title] = filename
-                    elif session_date > last_week:
-                        session_titles["Last Week"][session_title] = filename
-                    elif session_date > last_month:
-                        session_titles["Last Month"][session_title] = filename
-                    else:
-                        session_titles["Older"][session_title] = filename
+    limit = request.args.get('limit', -1, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    today = str(datetime.now().date())
+    with catalog_lock:
+        rows = catalog.execute("""SELECT filename, title, CASE
+                WHEN date(updated) = date(:today) THEN 'Today'
+                WHEN date(updated) > date(:today, '-7 days') THEN 'Last Week'
+                WHEN date(updated) > date(:today, '-30 days') THEN 'Last Month'
+                ELSE 'Older' END
+            FROM sessions WHERE title IS NOT NULL
+            ORDER BY updated DESC LIMIT :limit OFFSET :offset""",
+            {"today": today, "limit": limit, "offset": offset}).fetchall()
+    for filename, session_title, bucket in rows:
+        session_titles[bucket][session_title] = filename
     return jsonify(session_titles)
 
 @app.route('/api/choose_chat_history', methods=['POST'])
@@ -360,128 +2201,75 @@ def choose_chat_history():
     if selected_filename is None:
         return jsonify({"error": "Filename parameter missing"}), 400
 
-    session_file = None
-    for filename in os.listdir("prev_msgs"):
-        if filename == selected_filename and filename.endswith(".json"):
-            with open(os.path.join("prev_msgs", filename), 'r') as file:
-                session_data = json.load(file)
-                if session_data:
-                    session_file = session_data
-                    global current_session
-                    global current_session_updated
-                    current_session = os.path.join("prev_msgs", filename)
-                    current_session_data = json.load(open(current_session, 'r'))
-                    if current_session_data[0]["date"] != str(datetime.now()): current_session_updated = False
-                    break
+    # Sessions saved before the JSON Lines migration may still be referenced by their old name
+    if selected_filename.endswith(".json") and not find_in_catalog(selected_filename):
+        selected_filename += "l"
+
+    header = None
+    if find_in_catalog(selected_filename):
+        header, turns, summary = read_session_records(os.path.join("prev_msgs", selected_filename))
     
-    if session_file is None:
+    if not header:
         return jsonify({"error": "Session not found"}), 404
     
-    global memory
-    global settings
-    memory = ChatMemoryBuffer.from_defaults(token_limit=settings["token_limit"])
-    for data in session_file[1:]:
-        memory.put(ChatMessage.from_str(content=data['query']))
-        memory.put(ChatMessage.from_str(content=data['response'], role='assistant'))
-
-    global chat_engine
-    global llm
-    global selected_chat_engine_prompt
-    chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-        context_prompt=(
-            selected_chat_engine_prompt["value"]
-        ), memory=memory, verbose=True
-    )
-    return jsonify(session_file)
+    memory = load_session_memory(turns, summary)
+    chat = get_chat_session()
+    chat.session_file = os.path.join("prev_msgs", selected_filename)
+    chat.session_updated = False
+    chat.reset(memory)
+    if isinstance(memory, SummaryChatMemory):
+        summary_queue.put((chat.session_file, memory))
+    return jsonify([header] + turns)
 
 @app.route('/api/add_new_documents', methods=['POST'])
 def add_new_documents():
     print('Adding new documents')
     try:
-        with TemporaryDirectory() as temp_folder:
-            # Retrieve the form data
-            if 'metadata' not in request.form or 'files' not in request.files:
-                return jsonify({"error": "Missing files or metadata in form data"}), 400
-
-            files = request.files.getlist('files')
-            metadata = request.form.get('metadata')
-
-            if not files:
-                return jsonify({"error": "No files provided"}), 400
-
-            metadata = json.loads(metadata)
-
-            # Save files to the temporary directory, maintaining folder structure
-            for file in files:
-                relative_path = file.filename  # This will include the relative folder structure
-                save_path = os.path.join(temp_folder, relative_path)
-
-                # Create necessary directories
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-
-                # Save the file
-                file.save(save_path)
-
-            # Convert metadata from list of dicts to a single dict
-            meta = lambda filename: {"file_name": filename, **{m["key"]: m["value"] for m in metadata if m["key"] and m["value"]}}
-
-            # Collect all file paths for the SimpleDirectoryReader
-            files = [
-                os.path.join(root, name)
-                for root, _, filenames in os.walk(temp_folder)
-                for name in filenames
-            ]
-
-            # Use SimpleDirectoryReader to read the saved files
-            documents = SimpleDirectoryReader(input_files=files, file_metadata=meta, recursive=True).load_data()
-
-            if not documents:
-                return jsonify({"error": "No valid documents found"}), 400
-
-            # Update the vector index with the new documents
-            global vector_index
-            global chat_engine
-            global memory
-            global storage_context
-            global selected_chat_engine_prompt
-            global llm
-            global settings
-            
-            vector_index = vector_index.from_documents(documents, show_progress=True, storage_context=storage_context)
-            
-            # Update the chat engine to use the new documents
-            chat_engine = vector_index.as_chat_engine(
-                chat_mode=settings["chat_mode"],
-                llm=llm,
-                context_prompt=(selected_chat_engine_prompt["value"]),
-                memory=memory,
-                verbose=True
-            )
-
-            return jsonify({"success": "Documents added successfully"}), 200
+        # Retrieve the form data
+        if 'metadata' not in request.form or 'files' not in request.files:
+            return jsonify({"error": "Missing files or metadata in form data"}), 400
 
+        files = request.files.getlist('files')
+        metadata = request.form.get('metadata')
+
+        if not files:
+            return jsonify({"error": "No files provided"}), 400
+
+        metadata = json.loads(metadata)
+
+        # Convert metadata from list of dicts to a single dict
+        metadata = {m["key"]: m["value"] for m in metadata if m["key"] and m["value"]}
+
+        job = create_ingest_job(files, metadata)
+        return jsonify({"success": "Documents queued for ingestion", "job_id": job["id"], "status": job["status"]}), 202
+
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"Upload exceeds the {settings['max_upload_bytes']} byte limit"}), 413
     except Exception as e:
         print(e)
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
+    finally:
+        if hasattr(request, "upload_dir"):
+            shutil.rmtree(request.upload_dir, ignore_errors=True)
+
+@app.route('/api/ingest_jobs', methods=['GET'])
+def list_ingest_jobs():
+    return jsonify([ingest_job_status(job) for job in ingest_jobs.values()])
+
+@app.route('/api/ingest_jobs/<job_id>', methods=['GET'])
+def get_ingest_job(job_id):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(ingest_job_status(job))
 
 @app.route('/api/new_chat', methods=['GET'])
 def new_chat():
-    global current_session
-    global current_session_updated
-    current_session = None
-    current_session_updated = False
-    global memory
-    memory = ChatMemoryBuffer.from_defaults(token_limit=2048)
-    global chat_engine
-    global llm
-    global selected_chat_engine_prompt
-    global settings
-    chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-        context_prompt=(
-            selected_chat_engine_prompt["value"]
-        ), memory=memory, verbose=True
-    )
+    chat = get_chat_session()
+    chat.session_file = None
+    chat.session_updated = False
+    chat.reset(new_memory())
     return jsonify({"message": "New chat session started"})
 
 @app.route('/api/list_models', methods=['GET'])
@@ -496,88 +2284,148 @@ def list_models():
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
     
-@app.route('/api/select_model', methods=['POST'])
-def select_model():
+# Model pulls run as background jobs, one per model: selecting a model that is already being pulled
+# joins the running pull. Progress is streamed from /api/pull_jobs/<model>
+pull_jobs = {}
+pull_jobs_lock = threading.Lock()
+
+def pull_job_status(job):
+    return {key: job[key] for key in ("model", "type", "status", "detail", "completed", "total", "error", "created", "updated")}
+
+def update_pull_job(job, **changes):
+    with job["condition"]:
+        job.update(changes, updated=str(datetime.now()))
+        job["version"] += 1
+        job["condition"].notify_all()
+
+def pull_model(job):
+    layers = {}
+    try:
+        update_pull_job(job, status="pulling")
+        for progress in ollama_client.pull(job["model"], stream=True):
+            if digest := progress.get('digest'):
+                layers[digest] = (progress.get('completed', 0), progress.get('total', 0))
+            update_pull_job(job, detail=progress.get('status'), completed=sum(done for done, _ in layers.values()),
+                            total=sum(total for _, total in layers.values()))
+
+        # Registered only once the whole model is there
+        if job["model"] not in models[job["type"]]:
+            models[job["type"]].append(job["model"])
+        with open('models.json', 'w') as f:
+            json.dump(models, f)
+        if job["select"]:
+            apply_model_selection(job["model"], job["type"])
+        else:
+            # A pinned model that was still downloading can be warmed now
+            model_residency.wake.set()
+        update_pull_job(job, status="done")
+    except Exception as e:
+        print(f"Error pulling {job['model']}: {e}")
+        traceback.print_exc()
+        update_pull_job(job, status="failed", error=str(e))
+
+def wait_for_pull(model):
+    # Returns once a pull of the model started earlier has finished, raises if it failed
+    with pull_jobs_lock:
+        job = pull_jobs.get(model)
+    if job is None:
+        return
+    with job["condition"]:
+        job["condition"].wait_for(lambda: job["status"] in ("done", "failed"))
+    if job["status"] == "failed":
+        raise RuntimeError(f"Pulling {model} failed: {job['error']}")
+
+def start_pull(model, type, select=False):
+    with pull_jobs_lock:
+        job = pull_jobs.get(model)
+        if job is not None and job["status"] in ("queued", "pulling"):
+            # A later request to select the model still selects it when the pull finishes
+            job["select"] = job["select"] or select
+            return job
+        job = {"model": model, "type": "llm" if type == "llm" else "embed", "select": select, "status": "queued", "detail": None,
+               "completed": 0, "total": 0, "error": None, "created": str(datetime.now()), "updated": None,
+               "version": 0, "condition": threading.Condition()}
+        pull_jobs[model] = job
+    threading.Thread(target=pull_model, args=(job,), daemon=True).start()
+    return job
+
+def apply_model_selection(new_model, type):
     global current_model
-    global models
     global llm
-    global chat_engine
-    global memory
-    global vector_index
-    global selected_chat_engine_prompt
-    global settings
     global current_embed_model
 
-    data = request.json
-    new_model = data.get('model')
-    type = data.get('type')
-
-    if new_model is None:
-        return jsonify({"error": "Model parameter missing"}), 400
-    
-    if new_model not in models["llm"] and new_model not in models["embed"]:
-        try:
-            current_digest, bars = '', {}
-            for progress in ollama.pull(new_model, stream=True):
-                digest = progress.get('digest', '')
-                if digest != current_digest and current_digest in bars:
-                    bars[current_digest].close()
-
-                if not digest:
-                    print(progress.get('status'))
-                    continue
-
-                if digest not in bars and (total := progress.get('total')):
-                    bars[digest] = tqdm(total=total, desc=f'pulling {digest[7:19]}', unit='B', unit_scale=True)
-
-                if completed := progress.get('completed'):
-                    bars[digest].update(completed - bars[digest].n)
-
-                current_digest = digest
-                if type == "llm":
-                    models["llm"].append(new_model)
-                else:
-                    models["embed"].append(new_model)
-            
-        except Exception as e:
-            print(e)
-            traceback.print_exc()
-            return jsonify({"error": str(e)}), 500
-    
     if type == "llm":
         if new_model == current_model:
-            return jsonify({"message": "Model already selected"})
+            return False
         current_model = new_model
         llm = Ollama(model=new_model, request_timeout=120.0, base_url="http://localhost:11434")
         Settings.llm = llm
-        chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-            context_prompt=(
-                selected_chat_engine_prompt["value"]
-            ), memory=memory, verbose=True
-        )
     else:
         if new_model == current_embed_model:
-            return jsonify({"message": "Model already selected"})
+            return False
         current_embed_model = new_model
-        embed_model = OllamaEmbedding(model_name=new_model, base_url="http://localhost:11434")
+        embed_model = make_embed_model(new_model)
         Settings.embed_model = embed_model
-    
+        use_vector_store(new_model)
+    model_residency.pin(current_model, current_embed_model)
+
     with open('models.json', 'w') as f:
         json.dump(models, f)
+    return True
+
+@app.route('/api/select_model', methods=['POST'])
+def select_model():
+    data = request.json
+    new_model = data.get('model')
+    type = data.get('type')
+
+    if new_model is None:
+        return jsonify({"error": "Model parameter missing"}), 400
     
+    if new_model not in models["llm"] and new_model not in models["embed"]:
+        # Selected once the pull finishes
+        job = start_pull(new_model, type, select=True)
+        return jsonify({"message": "Pulling model", **pull_job_status(job), "status_url": f"/api/pull_jobs/{new_model}"}), 202
+
+    if not apply_model_selection(new_model, type):
+        return jsonify({"message": "Model already selected"})
     return jsonify({"message": "Model changed successfully"})
 
+@app.route('/api/pull_jobs', methods=['GET'])
+def list_pull_jobs():
+    return jsonify([pull_job_status(job) for job in list(pull_jobs.values())])
+
+@app.route('/api/pull_jobs/<path:model>', methods=['GET'])
+def get_pull_job(model):
+    job = pull_jobs.get(model)
+    if job is None:
+        return jsonify({"error": "Pull not found"}), 404
+    if "text/event-stream" not in request.headers.get('Accept', ''):
+        return jsonify(pull_job_status(job))
+
+    def stream_progress():
+        seen = -1
+        while True:
+            with job["condition"]:
+                # Time out now and then so a dead client is noticed while a layer downloads slowly
+                if job["version"] == seen:
+                    job["condition"].wait(15)
+                seen = job["version"]
+                status = pull_job_status(job)
+            yield f"data: {json.dumps(status)}\n\n"
+            if status["status"] in ("done", "failed"):
+                return
+
+    return app.response_class(stream_progress(), mimetype='text/event-stream', headers={"Cache-Control": "no-cache"})
+
 @app.route('/api/delete_model', methods=['POST'])
 def delete_model():
     global models
     global current_model
     global current_embed_model
     global llm
-    global chat_engine
-    global memory
     global vector_index
     global storage_context
-    global selected_chat_engine_prompt
     global settings
 
     data = request.json
@@ -593,19 +2441,16 @@ def delete_model():
                 current_model = "mistral:instruct"
                 llm = Ollama(model=current_model, request_timeout=120.0, base_url="http://localhost:11434", temperature=settings["temperature"], context_window=settings["context_window"])
                 Settings.llm = llm
-                chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-                    context_prompt=(
-                        selected_chat_engine_prompt["value"]
-                    ), memory=memory, verbose=True
-                )
             models["llm"] = [m for m in models["llm"] if m != model]
         else:
             if model == current_embed_model:
                 current_embed_model = "mxbai-embed-large:latest"
-                embed_model = OllamaEmbedding(model_name=current_embed_model, base_url="http://localhost:11434")
+                embed_model = make_embed_model(current_embed_model)
                 Settings.embed_model = embed_model
+                use_vector_store(current_embed_model)
             models["embed"] = [m for m in models["embed"] if m != model]
-        ollama.delete(model)
+        model_residency.pin(current_model, current_embed_model)
+        ollama_client.delete(model)
         with open('models.json', 'w') as f:
             json.dump(models, f)
         return jsonify({"message": "Model deleted successfully"})
@@ -631,8 +2476,6 @@ def update_prompts():
     global prompts
     global selected_LLM_prompt
     global selected_chat_engine_prompt
-    global chat_engine
-    global memory
     global settings
     try:
         data = request.json
@@ -647,12 +2490,6 @@ def update_prompts():
         
         with open('prompts.json', 'w') as f:
             json.dump(prompts, f)
-        
-        chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-            context_prompt=(
-                selected_chat_engine_prompt["value"]
-            ), memory=memory, verbose=True
-        )
         return jsonify({"message": "Prompts updated successfully"})
     except Exception as e:
         print(e)
@@ -691,13 +2528,7 @@ def get_settings():
 @app.route('/api/settings', methods=['POST'])
 def update_settings():
     global settings
-    global chat_engine
-    global memory
     global llm
-    global selected_chat_engine_prompt
-    global vector_store
-    global vector_index
-    global storage_context
     try:
         data = request.json
         settings["database"] = data.get('database')
@@ -709,6 +2540,8 @@ def update_settings():
         settings["context_window"] = data.get('context_window')
         settings["token_limit"] = data.get('token_limit')
         settings["chat_mode"] = data.get('chat_mode')
+        for key in optional_settings:
+            settings[key] = data.get(key, settings[key])
         
         with open('settings.json', 'w') as f:
             json.dump(settings, f)
@@ -717,15 +2550,11 @@ def update_settings():
         Settings.llm = llm
         Settings.chunk_size = settings["chunk_size"]
         Settings.chunk_overlap = settings["chunk_overlap"]
-        vector_store = Neo4jVectorStore(settings['database'], settings['password'], settings['uri'], 1024, hybrid_search=True)
-        vector_index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        memory = ChatMemoryBuffer.from_defaults(token_limit=settings["token_limit"])
-        chat_engine = vector_index.as_chat_engine(chat_mode=settings["chat_mode"], llm=llm,
-            context_prompt=(
-                selected_chat_engine_prompt["value"]
-            ), memory=memory, verbose=True
-        )
+        # Connection details may have changed: rebuild the stores on a new pool, the old one drains first
+        retire_neo4j_driver()
+        vector_stores.clear()
+        use_vector_store(current_embed_model)
+        reset_chat_memories()
         return jsonify({"message": "Settings updated successfully"})
     except Exception as e:
         print(e)
@@ -740,7 +2569,15 @@ def index():
 def start_flask_app():
     # Uncomment the line under to use FlaskUI
     # ui.run()
-    app.run(port=8000, debug=False)
+    # Both servers get a socket that is already bound, so the time to listening can be reported
+    if settings["async_server"]:
+        sock = socket.create_server(('127.0.0.1', 8000))
+        report_listening("http://127.0.0.1:8000")
+        uvicorn.Server(uvicorn.Config(asgi_app, lifespan="off")).run(sockets=[sock])
+    else:
+        server = make_server('127.0.0.1', 8000, app, threaded=True)
+        report_listening("http://127.0.0.1:8000")
+        server.serve_forever()
 
 def cleanup():
     global ollama_process
@@ -753,15 +2590,22 @@ def cleanup():
     os.system("neo4j stop")
 
 if __name__ == '__main__':
+    # Needed by the ingestion process pool in the bundled executable
+    multiprocessing.freeze_support()
     # Uncomment the line under to use FlaskUI
     # ui = FlaskUI(app=app, server="flask", width=1280, height=720, port=5000, on_shutdown=cleanup)
     try:
         create_directory_if_not_exists('prev_msgs')
-        start_services()
-        initialize_globals()
+        migrate_session_files()
+        init_catalog()
+        load_settings()
+        load_prompts()
+        # Starts Ollama and Neo4j, then the backends
+        threading.Thread(target=initialize_globals, daemon=True).start()
         start_flask_app()
         
     finally:
         print("Cleaning up...")
-        ollama_process.terminate()
+        if ollama_process:
+            ollama_process.terminate()
         os.system("neo4j stop")
@@ -0,0 +1,162 @@
+# Stand-in for the Ollama HTTP API, just enough of it for ToK: model listing, keep-alive requests,
+# embeddings and (streamed) chat/generate with a configurable latency per token.
+# Embeddings are hashed bags of words, so similar texts still land close to each other
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+
+WORD = re.compile(r"\w+")
+
+class FakeOllama:
+    def __init__(self, models=("mistral:instruct", "mxbai-embed-large:latest"), dimension=256, first_token_latency=0.05,
+                 token_latency=0.01, tokens=64, embed_latency=0.002, host="127.0.0.1", port=0):
+        self.models = list(models)
+        self.dimension = dimension
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.embed_latency = embed_latency
+        self.lock = threading.Lock()
+        self.calls = {}
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self, "GET", None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                fake.handle(self, "POST", json.loads(self.rfile.read(length) or b"{}"))
+
+            def do_DELETE(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                fake.handle(self, "DELETE", json.loads(self.rfile.read(length) or b"{}"))
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def embed(self, text):
+        vector = [0.0] * self.dimension
+        for word in WORD.findall(text.lower()):
+            digest = hashlib.blake2b(word.encode(), digest_size=8).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimension] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def answer(self):
+        return [f"token{i} " for i in range(self.tokens)]
+
+    def handle(self, handler, method, body):
+        path = handler.path.split("?", 1)[0]
+        with self.lock:
+            self.calls[path] = self.calls.get(path, 0) + 1
+        now = datetime.now(timezone.utc)
+
+        if path == "/api/tags":
+            return send_json(handler, {"models": [{"name": model, "model": model, "modified_at": now.isoformat(), "size": 0,
+                                                   "digest": "", "details": {}} for model in self.models]})
+        if path == "/api/ps":
+            expires = (now + timedelta(minutes=30)).isoformat()
+            return send_json(handler, {"models": [{"name": model, "model": model, "size": 0, "size_vram": 0,
+                                                   "expires_at": expires} for model in self.models]})
+        # Older clients name the model "name"
+        if path == "/api/pull":
+            model = body.get("model") or body.get("name")
+            if model not in self.models:
+                self.models.append(model)
+            return send_stream(handler, [{"status": "pulling manifest"}, {"status": "success"}], body.get("stream", True))
+        if path == "/api/delete":
+            model = body.get("model") or body.get("name")
+            if model in self.models:
+                self.models.remove(model)
+            return send_json(handler, {})
+        if path == "/api/embed":
+            inputs = body.get("input") or []
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            time.sleep(self.embed_latency * max(1, len(inputs)))
+            return send_json(handler, {"model": body.get("model"), "embeddings": [self.embed(text) for text in inputs]})
+        if path == "/api/embeddings":
+            time.sleep(self.embed_latency)
+            return send_json(handler, {"embedding": self.embed(body.get("prompt", ""))})
+        if path in ("/api/chat", "/api/generate"):
+            return self.generate(handler, path, body)
+        send_json(handler, {"error": f"{method} {path} is not implemented by the fake"}, 404)
+
+    def generate(self, handler, path, body):
+        chat = path == "/api/chat"
+        model = body.get("model")
+
+        def chunk(text, done):
+            payload = {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+            if chat:
+                payload["message"] = {"role": "assistant", "content": text}
+            else:
+                payload["response"] = text
+            if done:
+                payload.update({"done_reason": "stop", "eval_count": self.tokens, "prompt_eval_count": 0})
+            return payload
+
+        # A keep-alive request loads the model and returns right away
+        if not chat and not body.get("prompt"):
+            return send_json(handler, chunk("", True))
+
+        tokens = self.answer()
+        if not body.get("stream", True):
+            time.sleep(self.first_token_latency + self.token_latency * len(tokens))
+            return send_json(handler, chunk("".join(tokens).strip(), True))
+
+        def chunks():
+            time.sleep(self.first_token_latency)
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(self.token_latency)
+                yield chunk(token, False)
+            yield chunk("", True)
+        send_stream(handler, chunks(), True)
+
+def send_json(handler, payload, status=200):
+    body = json.dumps(payload).encode()
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+def send_stream(handler, payloads, stream):
+    if not stream:
+        return send_json(handler, list(payloads)[-1])
+    handler.send_response(200)
+    handler.send_header("Content-Type", "application/x-ndjson")
+    handler.send_header("Transfer-Encoding", "chunked")
+    handler.end_headers()
+    for payload in payloads:
+        line = json.dumps(payload).encode() + b"\n"
+        handler.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        handler.wfile.flush()
+    handler.wfile.write(b"0\r\n\r\n")
+    handler.wfile.flush()
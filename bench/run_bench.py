@@ -0,0 +1,354 @@
+# End-to-end benchmark of the ToK server. Runs docker/main.py in-process on the local vector store,
+# against a fake Ollama server with fixed latencies, and drives the real HTTP routes: document upload
+# and ingestion, queries (RAG and plain LLM), /api/history and /api/choose_chat_history.
+#
+# The corpus, the queries and the fake's latencies derive from the arguments and a seed, so two runs
+# with the same arguments are comparable. Results are written as JSON:
+#
+#   python bench/run_bench.py --output before.json
+#   python bench/run_bench.py --output after.json --compare before.json
+#
+# Everything the server writes (settings, sessions, caches, the index) goes to a scratch directory.
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from fake_ollama import FakeOllama
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(os.path.dirname(BENCH_DIR), "docker")
+LLM_MODEL = "mistral:instruct"
+EMBED_MODEL = "mxbai-embed-large:latest"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the ToK server against a fake Ollama and the local vector store")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--docs", type=int, default=200, help="documents to ingest")
+    parser.add_argument("--doc-words", type=int, default=800, help="words per document")
+    parser.add_argument("--sessions", type=int, default=8, help="chat sessions, each asking --turns questions in a row")
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions running at the same time")
+    parser.add_argument("--mode", choices=("rag", "llm", "both"), default="both", help="answer with the chat engine, the plain LLM or both")
+    parser.add_argument("--history-requests", type=int, default=50, help="requests to /api/history and /api/choose_chat_history each")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per fake answer")
+    parser.add_argument("--token-latency", type=float, default=0.01, help="seconds between fake tokens")
+    parser.add_argument("--first-token-latency", type=float, default=0.05, help="seconds before the first fake token")
+    parser.add_argument("--embed-latency", type=float, default=0.002, help="seconds per text embedded by the fake")
+    parser.add_argument("--dimension", type=int, default=256, help="dimension of the fake embeddings")
+    parser.add_argument("--threads", type=int, default=16, help="waitress worker threads")
+    parser.add_argument("--async-server", action="store_true", help="serve with uvicorn, like the async_server setting")
+    parser.add_argument("--settings", type=json.loads, default={}, help="JSON object merged into settings.json")
+    parser.add_argument("--workdir", help="scratch directory, a temporary one is used and removed by default")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    return parser.parse_args()
+
+# Synthetic corpus: pseudo-words drawn from a seeded vocabulary, so questions can name words that only
+# a few documents contain
+def make_vocabulary(rng, size=5000):
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "te", "vo", "zi", "pa", "do", "gu", "he", "ji", "ba", "fe"]
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def make_corpus(rng, docs, doc_words):
+    vocabulary = make_vocabulary(rng)
+    corpus = []
+    for i in range(docs):
+        words = [rng.choice(vocabulary) for _ in range(doc_words)]
+        sentences = [" ".join(words[j:j + 12]).capitalize() + "." for j in range(0, len(words), 12)]
+        corpus.append((f"doc_{i:05d}.txt", f"Document {i}.\n" + "\n".join(sentences)))
+    return corpus
+
+def make_questions(rng, corpus, count):
+    questions = []
+    for _ in range(count):
+        name, text = rng.choice(corpus)
+        words = text.split()
+        questions.append(f"What does {name} say about {rng.choice(words).strip('.').lower()} and {rng.choice(words).strip('.').lower()}?")
+    return questions
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    body = []
+    for name, value in fields:
+        body.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        body.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                    f'Content-Type: text/plain\r\n\r\n'.encode() + data.encode() + b"\r\n")
+    body.append(f"--{boundary}--\r\n".encode())
+    return b"".join(body), f"multipart/form-data; boundary={boundary}"
+
+class Client:
+    def __init__(self, port):
+        self.port = port
+
+    def call(self, method, path, body=None, headers=None):
+        # Returns the status, the body, the total time and the time to the first byte of the body
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+        start = time.perf_counter()
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            first_byte = None
+            chunks = []
+            while chunk := response.read1(65536):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                chunks.append(chunk)
+            return response.status, b"".join(chunks), time.perf_counter() - start, first_byte
+        finally:
+            connection.close()
+
+    def json(self, method, path, body=None, headers=None):
+        status, data, _, _ = self.call(method, path, body, headers)
+        return status, json.loads(data or b"null")
+
+class Samples:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = []
+        self.first_byte = []
+        self.errors = 0
+
+    def add(self, ok, seconds, first_byte=None):
+        with self.lock:
+            if not ok:
+                self.errors += 1
+                return
+            self.seconds.append(seconds)
+            if first_byte is not None:
+                self.first_byte.append(first_byte)
+
+    def summary(self):
+        summary = {"count": len(self.seconds), "errors": self.errors, **percentiles(self.seconds)}
+        if self.first_byte:
+            summary["first_byte"] = percentiles(self.first_byte)
+        return summary
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(fraction):
+        # Nearest rank
+        return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+    return {"mean": sum(ordered) / len(ordered), "p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "max": ordered[-1]}
+
+# The server runs in this process: main.py works relative to the current directory and reads the
+# Ollama address from the same environment variables docker-compose.yml sets, when imported
+def start_server(args, fake, workdir):
+    with open(os.path.join(SERVER_DIR, "settings.json")) as f:
+        settings = json.load(f)
+    settings["vector_backend"] = "local"
+    settings.update(args.settings)
+    with open(os.path.join(workdir, "settings.json"), "w") as f:
+        json.dump(settings, f)
+    with open(os.path.join(workdir, "models.json"), "w") as f:
+        json.dump({"llm": [LLM_MODEL], "embed": [EMBED_MODEL]}, f)
+    shutil.copy(os.path.join(SERVER_DIR, "prompts.json"), workdir)
+    os.chdir(workdir)
+
+    host, port = fake.server.server_address[:2]
+    os.environ["OLLAMA_HOST"] = host
+    os.environ["OLLAMA_PORT"] = str(port)
+    sys.path.insert(0, SERVER_DIR)
+    import main
+
+    main.create_directory_if_not_exists('prev_msgs')
+    main.migrate_session_files()
+    main.init_catalog()
+    main.load_settings()
+    main.load_prompts()
+    main.initialize_globals()
+    failed = {name: step for name, step in main.startup_steps.items() if step["state"] != "ready"}
+    if failed:
+        raise SystemExit(f"Server startup failed: {json.dumps(failed)}")
+
+    if args.async_server:
+        import uvicorn
+        sock = socket.create_server(("127.0.0.1", 0))
+        server = uvicorn.Server(uvicorn.Config(main.asgi_app, log_level="warning"))
+        threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+        while not server.started:
+            time.sleep(0.01)
+        return main, sock.getsockname()[1]
+
+    from waitress import create_server
+    server = create_server(main.app, host="127.0.0.1", port=0, threads=args.threads)
+    threading.Thread(target=server.run, daemon=True).start()
+    return main, server.effective_port
+
+def ingest(client, corpus):
+    body, content_type = multipart([("metadata", "[]")], [("files", name, text) for name, text in corpus])
+    start = time.perf_counter()
+    status, data, upload_seconds, _ = client.call("POST", "/api/add_new_documents", body, {"Content-Type": content_type})
+    if status != 202:
+        raise SystemExit(f"Upload failed with {status}: {data[:200]!r}")
+    job_id = json.loads(data)["job_id"]
+    while True:
+        _, job = client.json("GET", f"/api/ingest_jobs/{job_id}")
+        if job["status"] in ("completed", "failed"):
+            break
+        time.sleep(0.05)
+    seconds = time.perf_counter() - start
+    return {
+        "status": job["status"],
+        "upload_bytes": len(body),
+        "upload_seconds": upload_seconds,
+        "seconds": seconds,
+        "files": job["files"],
+        "files_skipped": job["files_skipped"],
+        "documents": job["documents"],
+        "chunks_written": job["chunks_written"],
+        "chunks_skipped": job["chunks_skipped"],
+        "chunks_per_second": job["chunks_written"] / seconds if seconds else 0.0,
+        "server_stats": job["stats"],
+        "errors": len(job["errors"])
+    }
+
+def run_sessions(client, args, questions, routes):
+    modes = {"rag": [True], "llm": [False], "both": [True, False]}[args.mode]
+
+    def session(index):
+        headers = {"X-Session-Id": f"bench-{index}"}
+        for turn in range(args.turns):
+            use_engine = modes[(index + turn) % len(modes)]
+            question = questions[(index * args.turns + turn) % len(questions)]
+            status, data, seconds, first_byte = client.call("POST", "/api/query", {"query": question, "useQueryEngine": use_engine}, headers)
+            ok = status == 200 and b"[ERROR]" not in data
+            routes["query_rag" if use_engine else "query_llm"].add(ok, seconds, first_byte)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(session, range(args.sessions)))
+
+def run_history(client, args, routes):
+    filenames = []
+    for _ in range(args.history_requests):
+        status, data, seconds, _ = client.call("GET", "/api/history")
+        routes["history"].add(status == 200, seconds)
+        if status == 200 and not filenames:
+            filenames = [filename for bucket in json.loads(data).values() for filename in bucket.values()]
+    for i in range(args.history_requests if filenames else 0):
+        status, _, seconds, _ = client.call("POST", "/api/choose_chat_history", {"filename": filenames[i % len(filenames)]},
+                                            {"X-Session-Id": f"bench-history-{i}"})
+        routes["choose_chat_history"].add(status == 200, seconds)
+
+def memory_high_water():
+    # Peak resident memory of the server (this process) and of the ingestion workers, in bytes
+    try:
+        import resource
+    except ImportError:
+        return {"server_bytes": None, "ingest_workers_bytes": None}
+    scale = 1 if sys.platform == "darwin" else 1024
+    return {"server_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            "ingest_workers_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Sections of the results that describe performance, as opposed to the run itself
+COMPARED = ("startup", "ingest", "ingest_unchanged", "routes", "queries_per_second", "memory")
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(base, results):
+    base_values = flatten({section: base[section] for section in COMPARED if section in base})
+    values = flatten({section: results[section] for section in COMPARED})
+    print(f"Compared with {base['meta'].get('commit')} ({base['meta'].get('date')})", file=sys.stderr)
+    for key in sorted(values):
+        if key not in base_values:
+            continue
+        before, after = base_values[key], values[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {key}: {before:.4g} -> {after:.4g} ({change})", file=sys.stderr)
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    corpus = make_corpus(rng, args.docs, args.doc_words)
+    questions = make_questions(rng, corpus, args.sessions * args.turns)
+
+    fake = FakeOllama(models=(LLM_MODEL, EMBED_MODEL), dimension=args.dimension, first_token_latency=args.first_token_latency,
+                      token_latency=args.token_latency, tokens=args.tokens, embed_latency=args.embed_latency).start()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="tok-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    output = os.path.abspath(args.output) if args.output else None
+    base = None
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+
+    try:
+        startup = time.perf_counter()
+        tok, port = start_server(args, fake, workdir)
+        startup = time.perf_counter() - startup
+        client = Client(port)
+
+        ingest_results = ingest(client, corpus)
+        # The same upload again only hashes the files, which is what re-syncing a folder costs
+        unchanged_results = ingest(client, corpus)
+
+        routes = {name: Samples() for name in ("query_rag", "query_llm", "history", "choose_chat_history")}
+        start = time.perf_counter()
+        run_sessions(client, args, questions, routes)
+        query_seconds = time.perf_counter() - start
+        run_history(client, args, routes)
+
+        results = {
+            "meta": {"commit": git_commit(), "date": str(datetime.now()), "python": platform.python_version(),
+                     "platform": platform.platform(), "cpus": os.cpu_count()},
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+            "startup": {"seconds": startup, "server_ready_after": tok.startup_times["ready"]},
+            "ingest": ingest_results,
+            "ingest_unchanged": unchanged_results,
+            "routes": {name: samples.summary() for name, samples in routes.items() if samples.seconds or samples.errors},
+            "queries_per_second": args.sessions * args.turns / query_seconds if query_seconds else 0.0,
+            "ollama_calls": dict(sorted(fake.calls.items())),
+            "memory": memory_high_water()
+        }
+    finally:
+        fake.stop()
+        os.chdir(BENCH_DIR)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if base is not None:
+        compare(base, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# llama-index and the Neo4j driver take seconds to import. main.py imports this module from its startup
+# thread, after the server is already listening
+from llama_index.llms.ollama import Ollama
+from llama_index.embeddings.ollama import OllamaEmbedding
+from llama_index.vector_stores.neo4jvector import Neo4jVectorStore
+from llama_index.core.prompts import ChatMessage
+from llama_index.core.llms import MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core import Settings, VectorStoreIndex, StorageContext, SimpleDirectoryReader
+from llama_index.core.schema import MetadataMode
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.chat_engine import CondensePlusContextChatEngine, ContextChatEngine
+from llama_index.core.postprocessor import SentenceTransformerRerank
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore, TextNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from metrics import ollama_seconds, ollama_errors, neo4j_seconds, neo4j_errors
+from collections import Counter
+from contextlib import contextmanager
+import neo4j
+import asyncio
+import contextvars
+import threading
+import math
+import re
+import time
+
+# Embed model wrapper that answers from the on-disk embedding cache and only sends misses to the
+# wrapped model. Used for queries and by llama-index; bulk ingestion goes through the cache directly
+class CachedEmbedding(BaseEmbedding):
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: object = PrivateAttr()
+
+    def __init__(self, inner, cache, **kwargs):
+        super().__init__(model_name=inner.model_name, embed_batch_size=inner.embed_batch_size, **kwargs)
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def _get_query_embedding(self, query):
+        return self._cache.cached("query", [query], self._embed_queries)[0]
+
+    def _embed_queries(self, queries):
+        with ollama_seconds.time("query_embed", errors=ollama_errors):
+            return [self._inner._get_query_embedding(queries[0])]
+
+    # The cache and the wrapped model both block, keep them off the event loop
+    async def _aget_query_embedding(self, query):
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text):
+        return await asyncio.to_thread(self._get_text_embedding, text)
+
+    async def _aget_text_embeddings(self, texts):
+        return await asyncio.to_thread(self._get_text_embeddings, texts)
+
+    def _get_text_embeddings(self, texts):
+        return self._cache.cached("text", texts, self._embed_texts)
+
+    def _embed_texts(self, texts):
+        with ollama_seconds.time("embed", errors=ollama_errors):
+            return self._inner._get_text_embeddings(texts)
+
+# Chat memory that puts a rolling summary of older turns in front of the most recent turns. main.py's
+# summary worker folds turns into the summary after a reply, outside the request
+def turn_starts(messages):
+    # A turn starts at a user message that doesn't follow another one, so a question recorded twice counts once
+    return [i for i, message in enumerate(messages)
+            if message.role == MessageRole.USER and (i == 0 or messages[i - 1].role != MessageRole.USER)]
+
+class SummaryChatMemory(ChatMemoryBuffer):
+    summary: str = ""
+    # Turns of the session before the ones held verbatim, i.e. covered by the summary
+    summarized_turns: int = 0
+    _lock: object = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls):
+        return "SummaryChatMemory"
+
+    def get(self, initial_token_count=0, **kwargs):
+        if not self.summary:
+            return super().get(initial_token_count=initial_token_count, **kwargs)
+        summary = ChatMessage(role=MessageRole.SYSTEM, content=f"Summary of the conversation so far:\n{self.summary}")
+        # The summary's tokens count against the limit, so older verbatim turns are dropped to make room
+        summary_tokens = len(self.tokenizer_fn(summary.content))
+        return [summary] + super().get(initial_token_count=initial_token_count + summary_tokens, **kwargs)
+
+    def put(self, message):
+        with self._lock:
+            super().put(message)
+
+    def turns_to_fold(self, keep_turns, min_turns):
+        # Messages of all but the last keep_turns turns, once at least min_turns of them have piled up
+        messages = self.get_all()
+        starts = turn_starts(messages)
+        if len(starts) - keep_turns < min_turns:
+            return []
+        return messages[:starts[-keep_turns] if keep_turns else len(messages)]
+
+    def fold(self, messages, summary):
+        # Replaces the folded messages with the new summary, unless the memory changed underneath
+        with self._lock:
+            current = self.get_all()
+            if current[:len(messages)] != messages:
+                return False
+            self.set(current[len(messages):])
+            self.summary = summary
+            self.summarized_turns += len(turn_starts(messages))
+            return True
+
+# Neo4j retrieval with a weighted hybrid score: alpha * vector score + (1 - alpha) * keyword score, the
+# keyword scores normalized by the best one. alpha 1 is vector search only, alpha 0 keyword search only
+VECTOR_BRANCH = """CALL db.index.vector.queryNodes($index, $k, $embedding) YIELD node, score
+    RETURN node, score * $alpha AS score"""
+KEYWORD_BRANCH = """CALL db.index.fulltext.queryNodes($keyword_index, $query, {limit: $k}) YIELD node, score
+    WITH collect({node: node, score: score}) AS nodes, max(score) AS max
+    UNWIND nodes AS n
+    RETURN n.node AS node, (n.score / max) * (1 - $alpha) AS score"""
+
+def lucene_terms(text):
+    # Lucene query syntax characters would make the full-text query fail
+    return re.sub(r'[+\-&|!(){}\[\]^"~*?:\\/]', ' ', text).strip()
+
+def record_to_node(record):
+    try:
+        node = metadata_dict_to_node(record["metadata"])
+        node.set_content(str(record["text"]))
+    except Exception:
+        node = TextNode(text=str(record["text"]), id_=record["id"], metadata=record["metadata"])
+    return node
+
+class Neo4jHybridRetriever(BaseRetriever):
+    def __init__(self, store, embed_model, similarity_top_k, alpha, callback_manager=None):
+        super().__init__(callback_manager=callback_manager)
+        self._store = store
+        self._embed_model = embed_model
+        self._top_k = similarity_top_k
+        self._alpha = min(max(alpha, 0.0), 1.0)
+
+    def _retrieve(self, query_bundle):
+        store = self._store
+        params = {"k": self._top_k, "alpha": self._alpha, "index": store.index_name, "keyword_index": store.keyword_index_name}
+        branches = []
+        if self._alpha > 0:
+            params["embedding"] = query_bundle.embedding or self._embed_model.get_query_embedding(query_bundle.query_str)
+            branches.append(VECTOR_BRANCH)
+        params["query"] = lucene_terms(query_bundle.query_str)
+        if self._alpha < 1 and params["query"]:
+            branches.append(KEYWORD_BRANCH)
+        if not branches:
+            return []
+
+        text, embedding = store.text_node_property, store.embedding_node_property
+        query = ("CALL {\n    " + "\n    UNION ALL\n    ".join(branches) + "\n}\n"
+                 "WITH node, sum(score) AS score ORDER BY score DESC LIMIT $k\n"
+                 f"RETURN node.`{text}` AS text, score, node.id AS id, "
+                 f"node {{.*, `{text}`: Null, `{embedding}`: Null, id: Null}} AS metadata")
+        with neo4j_seconds.time("retrieve", errors=neo4j_errors):
+            records = store.database_query(query, params=params)
+        return [NodeWithScore(node=record_to_node(record), score=record["score"]) for record in records]
+
+    async def _aretrieve(self, query_bundle):
+        # The Neo4j driver is synchronous
+        return await asyncio.to_thread(self._retrieve, query_bundle)
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+# Reranks retrieved nodes by BM25 against the query, computed over the candidates alone. Far cheaper
+# than a cross-encoder and catches chunks that matched on embedding similarity but not on content
+class LexicalReranker(BaseNodePostprocessor):
+    top_n: int = 2
+    k1: float = 1.2
+    b: float = 0.75
+
+    @classmethod
+    def class_name(cls):
+        return "LexicalReranker"
+
+    def _postprocess_nodes(self, nodes, query_bundle=None):
+        if query_bundle is None or not nodes:
+            return nodes[:self.top_n]
+        with self.callback_manager.event(CBEventType.RERANKING, payload={EventPayload.NODES: nodes, EventPayload.QUERY_STR: query_bundle.query_str}) as event:
+            terms = set(tokenize(query_bundle.query_str))
+            documents = [Counter(tokenize(node.node.get_content())) for node in nodes]
+            average_length = sum(sum(document.values()) for document in documents) / len(documents) or 1.0
+            scores = []
+            for document in documents:
+                length = sum(document.values())
+                score = 0.0
+                for term in terms:
+                    if not document[term]:
+                        continue
+                    frequency = sum(1 for other in documents if other[term])
+                    idf = math.log(1 + (len(documents) - frequency + 0.5) / (frequency + 0.5))
+                    score += idf * document[term] * (self.k1 + 1) / (document[term] + self.k1 * (1 - self.b + self.b * length / average_length))
+                scores.append(score)
+            ranked = sorted(zip(scores, range(len(nodes))), key=lambda pair: pair[0], reverse=True)[:self.top_n]
+            reranked = [NodeWithScore(node=nodes[i].node, score=score) for score, i in ranked]
+            event.on_end(payload={EventPayload.NODES: reranked})
+        return reranked
+
+# Wall time spent per llama-index stage (retrieve, reranking, llm, embedding, ...), from callback events
+class StageTimer(BaseCallbackHandler):
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.lock = threading.Lock()
+        self.starts = {}
+        self.stages = {}
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        self.starts[event_id] = time.perf_counter()
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        start = self.starts.pop(event_id, None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        trace = current_trace.get()
+        if trace is not None:
+            trace.add(event_type.value, elapsed)
+        with self.lock:
+            stage = self.stages.setdefault(event_type.value, {"count": 0, "seconds_total": 0.0, "seconds_max": 0.0, "seconds_last": 0.0})
+            stage["count"] += 1
+            stage["seconds_total"] += elapsed
+            stage["seconds_max"] = max(stage["seconds_max"], elapsed)
+            stage["seconds_last"] = elapsed
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
+
+    def stats(self):
+        with self.lock:
+            return {name: {**stage, "seconds_avg": stage["seconds_total"] / stage["count"]} for name, stage in self.stages.items()}
+
+# Spans of the turn being answered. The query path sets it while it condenses, retrieves and builds
+# the prompt, and the stage timer adds the llama-index events of that context to it
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class QueryTrace:
+    def __init__(self, model, cached=False):
+        self.model = model
+        self.cached = cached
+        self.start = time.perf_counter()
+        self.spans = Counter()
+        self.setup = None
+        self.first_token = None
+        self.last_token = None
+        self.tokens = 0
+
+    def add(self, stage, elapsed):
+        # The answer itself is timed per token, spans only cover the work before it
+        if self.setup is None:
+            self.spans[stage] += elapsed
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def setup_done(self):
+        self.setup = time.perf_counter() - self.start
+
+    def token(self):
+        self.last_token = time.perf_counter() - self.start
+        if self.first_token is None:
+            self.first_token = self.last_token
+        self.tokens += 1
+
+    def setup_timings(self):
+        # Known before the first token, so they can go out as a header
+        setup = self.setup if self.setup is not None else time.perf_counter() - self.start
+        spans = {
+            "queue": self.spans["queue"],
+            "condense": self.spans[CBEventType.LLM.value],
+            "embed": self.spans[CBEventType.EMBEDDING.value],
+            "retrieve": self.spans[CBEventType.RETRIEVE.value],
+            "rerank": self.spans[CBEventType.RERANKING.value]
+        }
+        # Embedding happens within retrieval, whatever else the setup took went into the prompt
+        spans["prompt_build"] = max(0.0, setup - spans["queue"] - spans["condense"] - spans["retrieve"] - spans["rerank"])
+        return spans
+
+    def timings(self):
+        generation = (self.last_token - self.first_token) if self.tokens > 1 else 0.0
+        return {
+            "model": self.model,
+            "cached": self.cached,
+            **self.setup_timings(),
+            # From the start of the turn, and from the end of the setup (model load and prompt eval)
+            "first_token": self.first_token,
+            "first_token_wait": self.first_token - self.setup if self.first_token is not None and self.setup is not None else None,
+            "total": time.perf_counter() - self.start,
+            "tokens": self.tokens,
+            "tokens_per_second": (self.tokens - 1) / generation if generation else 0.0
+        }
+
+    def server_timing(self):
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.setup_timings().items())
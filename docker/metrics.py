@@ -0,0 +1,195 @@
+# Prometheus metrics without a client library. Every thread writes to its own shard, so recording a
+# value in the hot path is a couple of dict operations and takes no lock; a scrape sums the shards
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# New shards between two folds of the shards of exited threads
+FOLD_EVERY = 64
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metrics = []
+        self.collectors = []
+        self.shards = []
+        # Registered without the lock, a deque append is atomic
+        self.new_shards = deque()
+        # Totals of threads that have exited, so counters never go backwards
+        self.retired = {}
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            self.new_shards.append((threading.current_thread(), shard))
+            # Threaded servers start a thread per request, so exited threads are folded as they pile up
+            # and not only at scrape time. If a scrape is folding already, the next new thread retries
+            if len(self.new_shards) >= FOLD_EVERY and self.lock.acquire(blocking=False):
+                try:
+                    self.fold()
+                finally:
+                    self.lock.release()
+        return shard
+
+    def fold(self):
+        # Called with the lock held: merges the shards of exited threads into the retired totals
+        while self.new_shards:
+            self.shards.append(self.new_shards.popleft())
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                merge(self.retired, shard)
+        self.shards = live
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(self, name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(self, name, help, labels, buckets))
+
+    def collector(self, collect):
+        # collect() returns [(name, type, help, [(labels dict, value), ...]), ...], read at scrape time
+        self.collectors.append(collect)
+        return collect
+
+    def totals(self):
+        with self.lock:
+            self.fold()
+            live = [shard for _, shard in self.shards]
+            totals = {key: list(value) if isinstance(value, list) else value for key, value in self.retired.items()}
+        for shard in live:
+            # dict.copy() is atomic under the GIL, the owning thread may keep writing meanwhile
+            merge(totals, shard.copy())
+        return totals
+
+    def render(self):
+        totals = self.totals()
+        lines = []
+        for metric in self.metrics:
+            lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.type}"]
+            values = sorted((key[1], value) for key, value in totals.items() if key[0] == metric.name)
+            lines += metric.render(values)
+        for collect in self.collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                lines.append(f"# collector {collect.__name__} failed: {escape(e)}")
+                continue
+            for name, kind, help, samples in families:
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{format_labels(labels.keys(), labels.values())} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def merge(into, shard):
+    for key, value in shard.items():
+        if isinstance(value, list):
+            current = into.setdefault(key, [0] * len(value))
+            for i, item in enumerate(list(value)):
+                current[i] += item
+        else:
+            into[key] = into.get(key, 0.0) + value
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, registry, name, help, labels):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def inc(self, *labels, amount=1.0):
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def render(self, values):
+        return [f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}" for labels, value in values]
+
+class Gauge(Counter):
+    # Summed over the shards like a counter, so a dec() on another thread than the inc() still balances
+    type = "gauge"
+
+    def dec(self, *labels, amount=1.0):
+        self.inc(*labels, amount=-amount)
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labels, buckets):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # Per-bucket counts (the last one is +Inf), then the sum and the count
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        values = shard.get(key)
+        if values is None:
+            values = shard[key] = [0] * (len(self.buckets) + 3)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    @contextmanager
+    def time(self, *labels, errors=None):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                errors.inc(*labels)
+            raise
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self, values):
+        lines = []
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(counts[-2])}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {counts[-1]}")
+        return lines
+
+registry = Registry()
+
+# Calls to the external services, recorded both here and in backends.py
+ollama_seconds = registry.histogram("tok_ollama_request_seconds", "Duration of Ollama calls by operation", ("operation",))
+ollama_errors = registry.counter("tok_ollama_errors_total", "Failed Ollama calls by operation", ("operation",))
+neo4j_seconds = registry.histogram("tok_neo4j_query_seconds", "Duration of Neo4j queries by operation", ("operation",))
+neo4j_errors = registry.counter("tok_neo4j_errors_total", "Failed Neo4j queries by operation", ("operation",))
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+sys.path.insert(0, APP_DIR)
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # main.py keeps its settings, sessions and indexes relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+@pytest.fixture
+def server(workdir):
+    # The server module with the backends loaded, a mock LLM and embed model and an empty local index
+    import main
+    from llama_index.core.llms.mock import MockLLM
+    from llama_index.core.embeddings.mock_embed_model import MockEmbedding
+
+    main.load_settings()
+    main.settings.update({"vector_backend": "local", "memory_mode": "summary"})
+    main.import_backends()
+    main.models = {"llm": ["mock"], "embed": ["mock"], "dimensions": {"mock": 8}}
+    main.llm = main.Settings.llm = MockLLM(max_tokens=4)
+    main.Settings.embed_model = MockEmbedding(embed_dim=8)
+    # Word counts instead of tiktoken, whose encoding would be downloaded
+    main.Settings.tokenizer = str.split
+    main.current_model = "mock"
+    main.current_embed_model = "mock"
+    main.selected_LLM_prompt = {"label": "default_prompt", "value": ""}
+    main.selected_chat_engine_prompt = {"label": "default_prompt", "value": "Context:\n{context_str}"}
+    main.create_directory_if_not_exists("prev_msgs")
+    main.init_catalog()
+    main.local_stores.clear()
+    main.vector_stores.clear()
+    main.use_vector_store("mock")
+    yield main
+    main.close_session_logs()
+    main.catalog.close()
+    main.chat_sessions.clear()
+    main.idle_chat_engines.clear()
+
+@pytest.fixture
+def ask(server):
+    # One chat-engine turn through the query path, answered by the engine or from the cache
+    def ask(chat, question):
+        turn, error = server.prepare_query(chat, {"query": question, "useQueryEngine": True})
+        assert error is None
+        if turn["cached_answer"] is not None:
+            answer = turn["cached_answer"]
+        else:
+            answer = "".join(turn["chat_engine"].stream_chat(turn["query"]).response_gen)
+        server.finish_query(turn, answer)
+        return turn
+    return ask
@@ -0,0 +1,49 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+def call(asgi_app, path):
+    # A GET through the ASGI app, returns the status and the body
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    messages = []
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+                 "query_string": b"", "root_path": "", "headers": [(b"x-session-id", b"asgi")],
+                 "server": ("127.0.0.1", 8000), "client": ("127.0.0.1", 50000)}
+        await asgi_app(scope, receive, send)
+        return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+    return run()
+
+class SlowStageTimer:
+    def stats(self):
+        time.sleep(0.5)
+        return {"slow": True}
+
+@pytest.fixture
+def started(server, monkeypatch):
+    monkeypatch.setattr(server, "stage_timer", SlowStageTimer())
+    server.startup_done.set()
+    yield server
+    server.startup_done.clear()
+
+def test_flask_routes_run_concurrently(started):
+    async def both():
+        return await asyncio.gather(call(started.asgi_app, "/api/stage_times"), call(started.asgi_app, "/api/stage_times"))
+    start = time.perf_counter()
+    responses = asyncio.run(both())
+    elapsed = time.perf_counter() - start
+
+    assert [(status, json.loads(body)) for status, body in responses] == [(200, {"slow": True})] * 2
+    assert elapsed < 0.9
+
+def test_flask_routes_are_counted_under_asgi(started):
+    before = started.registry.totals().get(("tok_http_requests_total", ("stage_times", "GET", "200")), 0)
+    asyncio.run(call(started.asgi_app, "/api/stage_times"))
+    assert started.registry.totals()[("tok_http_requests_total", ("stage_times", "GET", "200"))] == before + 1
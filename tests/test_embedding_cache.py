@@ -0,0 +1,61 @@
+import pytest
+
+@pytest.fixture
+def cache_class(workdir):
+    import main
+    return main.EmbeddingCache
+
+def vector(i):
+    return [float(i), 1.0, 0.0]
+
+def test_hits_and_misses(cache_class):
+    cache = cache_class("model", 8, "float32")
+    computed = []
+    def compute(texts):
+        computed.extend(texts)
+        return [vector(len(text)) for text in texts]
+
+    assert cache.cached("text", ["a", "bb"], compute) == [vector(1), vector(2)]
+    # Whitespace differences map to the same entry
+    assert cache.cached("text", ["a ", "bb", "ccc"], compute) == [vector(1), vector(2), vector(3)]
+    assert computed == ["a", "bb", "ccc"]
+    assert (cache.hits, cache.misses, cache.count) == (2, 3, 3)
+
+def test_least_recently_used_entries_are_evicted_in_bulk(cache_class):
+    cache = cache_class("model", 4, "float32")
+    cache.put_many("text", ["a", "b", "c", "d"], [vector(i) for i in range(4)])
+    # The hits on "a" and "c" are only noted in memory until the insert needs them
+    assert cache.get_many("text", ["a", "c"]) == [vector(0), vector(2)]
+    assert cache.touched
+
+    cache.put_many("text", ["e", "f", "c"], [vector(4), vector(5), vector(6)])
+    assert cache.count == 4
+    assert cache.get_many("text", ["a", "b", "c", "d", "e", "f"]) == [vector(0), None, vector(6), None, vector(4), vector(5)]
+
+def test_batch_larger_than_the_cache_keeps_its_last_entries(cache_class):
+    cache = cache_class("model", 2, "float32")
+    cache.put_many("text", ["a", "b", "c"], [vector(i) for i in range(3)])
+    assert cache.get_many("text", ["a", "b", "c"]) == [None, vector(1), vector(2)]
+
+def test_touches_are_written_in_batches(cache_class, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "TOUCH_BATCH", 3)
+    cache = cache_class("model", 8, "float32")
+    cache.put_many("text", ["a", "b", "c"], [vector(i) for i in range(3)])
+    before = dict(cache.db.execute("SELECT key, last_used FROM entries"))
+    cache.get_many("text", ["a", "b"])
+    assert dict(cache.db.execute("SELECT key, last_used FROM entries")) == before
+    cache.get_many("text", ["c"])
+    assert not cache.touched
+    after = dict(cache.db.execute("SELECT key, last_used FROM entries"))
+    assert all(after[key] >= before[key] for key in before) and after != before
+
+def test_reopened_cache_keeps_its_entries(cache_class):
+    cache = cache_class("model", 4, "float16")
+    cache.put_many("query", ["a", "b"], [vector(1), vector(2)])
+    cache.db.close()
+    reopened = cache_class("model", 4, "float16")
+    assert reopened.count == 2
+    assert reopened.get_many("query", ["a", "b", "c"]) == [vector(1), vector(2), None]
+    reopened.put_many("query", ["c"], [vector(3)])
+    assert reopened.db.execute("SELECT row FROM entries ORDER BY row").fetchall() == [(0,), (1,), (2,)]
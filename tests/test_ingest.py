@@ -0,0 +1,95 @@
+import io
+import json
+import os
+
+import pytest
+from llama_index.core.node_parser import SentenceSplitter
+from werkzeug.datastructures import FileStorage
+
+class FakeOllama:
+    # Embeds every text as the same vector and remembers what it was asked to embed
+    def __init__(self):
+        self.embedded = []
+
+    def embed(self, model, input):
+        self.embedded.extend(input)
+        return {"embeddings": [[1.0] + [0.0] * 7 for _ in input]}
+
+@pytest.fixture
+def ingest(server, monkeypatch):
+    # Stages the files as a job and runs it, as the ingestion worker would
+    ollama = FakeOllama()
+    monkeypatch.setattr(server, "ollama_client", ollama)
+    monkeypatch.setattr(server, "embedding_caches", {})
+    monkeypatch.setitem(server.settings, "ingest_workers", 1)
+    # A few words per chunk, so one file has several chunks
+    monkeypatch.setattr(server.Settings, "node_parser", SentenceSplitter(chunk_size=12, chunk_overlap=0))
+    server.init_manifest()
+
+    def ingest(files, done=()):
+        job = server.create_ingest_job([FileStorage(io.BytesIO(text.encode()), filename=name) for name, text in files.items()], {})
+        assert server.ingest_queue.get_nowait() is job
+        job["files_done"].extend(done)
+        return server.ingest_files(job)
+    ingest.ollama = ollama
+    yield ingest
+    server.manifest.close()
+    server.ingest_jobs.clear()
+
+def stored_ids(server):
+    return {row[0] for row in server.vector_store._db.execute("SELECT id FROM nodes")}
+
+NOTES = ("Apples grow on trees in the orchard.\n\nBananas are yellow and grow in bunches.\n\n"
+         "Cherries are small and red and sweet.")
+
+def test_upload_is_staged_as_a_job(server, ingest):
+    job = server.create_ingest_job([FileStorage(io.BytesIO(b"a"), filename="docs/a.txt"),
+                                    FileStorage(io.BytesIO(b"b"), filename="../b.txt")], {"source": "test"})
+    assert server.ingest_queue.get_nowait() is job
+
+    assert job["files"] == [os.path.join("docs", "a.txt"), "b.txt"]
+    with open(os.path.join(job["dir"], "job.json")) as f:
+        assert json.load(f)["status"] == "queued"
+    assert os.path.isfile(os.path.join(job["dir"], "files", "b.txt"))
+
+def test_files_are_chunked_embedded_and_written(server, ingest):
+    job = ingest({"notes.txt": NOTES, "other.txt": "Dates come from palm trees."})
+
+    assert job["errors"] == []
+    assert job["documents"] == 2
+    assert job["chunks_written"] == job["chunks_embedded"] > 2
+    assert job["files_done"] == ["notes.txt", "other.txt"]
+    assert stored_ids(server) == server.manifest_node_ids("notes.txt") | server.manifest_node_ids("other.txt")
+    assert server.manifest_file_hash("notes.txt") is not None
+
+def test_unchanged_files_are_skipped(server, ingest):
+    ingest({"notes.txt": NOTES})
+    before = stored_ids(server)
+    embedded = len(ingest.ollama.embedded)
+    job = ingest({"notes.txt": NOTES})
+
+    assert job["files_skipped"] == 1
+    assert job["files_parsed"] == 0
+    assert job["chunks_written"] == 0
+    assert len(ingest.ollama.embedded) == embedded
+    assert stored_ids(server) == before
+
+def test_changed_file_only_replaces_changed_chunks(server, ingest):
+    ingest({"notes.txt": NOTES})
+    before = stored_ids(server)
+    job = ingest({"notes.txt": NOTES.replace("red and sweet", "dark and sour")})
+
+    assert job["chunks_skipped"] == len(before) - 1
+    assert job["chunks_written"] == 1
+    assert job["chunks_deleted"] == 1
+    after = stored_ids(server)
+    assert len(after) == len(before)
+    assert len(after - before) == 1
+    assert after == server.manifest_node_ids("notes.txt")
+
+def test_resumed_job_skips_files_already_done(server, ingest):
+    job = ingest({"notes.txt": NOTES, "other.txt": "Dates come from palm trees."}, done=["notes.txt"])
+
+    assert job["files_parsed"] == 1
+    assert server.manifest_node_ids("notes.txt") == set()
+    assert stored_ids(server) == server.manifest_node_ids("other.txt")
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryMode
+
+import local_store
+from local_store import LocalVectorStore
+
+def make_node(node_id, text, embedding, doc_id=None):
+    node = TextNode(id_=node_id, text=text, embedding=list(embedding))
+    if doc_id:
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=doc_id)
+    return node
+
+def axis(dimension, i):
+    vector = np.zeros(dimension)
+    vector[i] = 1.0
+    return vector
+
+@pytest.fixture
+def store(workdir):
+    store = LocalVectorStore(str(workdir / "index"), 4)
+    store.add([make_node("a", "apples grow on trees", axis(4, 0), "doc1"),
+               make_node("b", "bananas are yellow", axis(4, 1), "doc1"),
+               make_node("c", "cherries and apples", axis(4, 2), "doc2")])
+    yield store
+    store.close()
+
+def vector_query(store, embedding, top_k=3):
+    return store.query(VectorStoreQuery(query_embedding=list(embedding), similarity_top_k=top_k))
+
+def test_vector_query_ranks_by_cosine(store):
+    result = vector_query(store, [0.9, 0.1, 0.0, 0.0])
+    assert result.ids[:2] == ["a", "b"]
+    assert result.nodes[0].get_content() == "apples grow on trees"
+    assert result.similarities[0] > result.similarities[1]
+
+def test_readding_a_node_replaces_it(store):
+    store.add([make_node("a", "apricots", axis(4, 3), "doc1")])
+    result = vector_query(store, axis(4, 3), top_k=1)
+    assert result.ids == ["a"]
+    assert result.nodes[0].get_content() == "apricots"
+    # The old vector is gone, nothing is close to it any more
+    result = vector_query(store, axis(4, 0), top_k=10)
+    assert sorted(result.ids) == ["a", "b", "c"]
+    assert max(result.similarities) == 0.5
+
+def test_delete_by_document_and_by_node(store):
+    store.delete("doc1")
+    assert vector_query(store, axis(4, 0)).ids == ["c"]
+    store.delete_nodes(["c"])
+    assert vector_query(store, axis(4, 2)).ids == []
+
+def test_bm25_text_search(store):
+    result = store.query(VectorStoreQuery(query_str="yellow bananas", similarity_top_k=3, mode=VectorStoreQueryMode.TEXT_SEARCH))
+    assert result.ids == ["b"]
+    result = store.query(VectorStoreQuery(query_str="apples", similarity_top_k=3, mode=VectorStoreQueryMode.TEXT_SEARCH))
+    assert set(result.ids) == {"a", "c"}
+    assert result.similarities[0] == 1.0
+
+def test_hybrid_query_weights_both_scores(store):
+    # The vector side points at "b", the keywords at "c"
+    def hybrid(alpha):
+        return store.query(VectorStoreQuery(query_embedding=list(axis(4, 1)), query_str="cherries", similarity_top_k=1,
+                                            mode=VectorStoreQueryMode.HYBRID, alpha=alpha)).ids
+    assert hybrid(1.0) == ["b"]
+    assert hybrid(0.0) == ["c"]
+
+def test_reopened_store_keeps_its_nodes(store):
+    store.close()
+    reopened = LocalVectorStore(store.path, 4)
+    try:
+        assert vector_query(reopened, axis(4, 1), top_k=1).ids == ["b"]
+    finally:
+        reopened.close()
+
+def test_ivf_index_finds_stored_vectors(workdir, monkeypatch):
+    monkeypatch.setattr(local_store, "BRUTE_FORCE_ROWS", 64)
+    vectors = np.random.default_rng(1).normal(size=(300, 16))
+    store = LocalVectorStore(str(workdir / "ivf"), 16, nprobe=2)
+    try:
+        store.add([make_node(f"n{i}", f"chunk {i}", vector) for i, vector in enumerate(vectors[:200])])
+        assert store._centroids is not None
+        # Rows added after training have no cluster and are still found
+        store.add([make_node(f"n{i}", f"chunk {i}", vector) for i, vector in enumerate(vectors[200:], 200)])
+        for i in (0, 150, 250, 299):
+            assert vector_query(store, vectors[i], top_k=1).ids == [f"n{i}"]
+    finally:
+        store.close()
@@ -0,0 +1,40 @@
+import sqlite3
+
+def test_manifest_is_kept_per_store(server):
+    server.init_manifest()
+    try:
+        server.update_manifest("notes.txt", "hash1", {"node1": "chunk1"})
+        assert server.manifest_file_hash("notes.txt") == "hash1"
+        assert server.manifest_node_ids("notes.txt") == {"node1"}
+
+        # Another index, as after switching backends, has not seen the file
+        local = server.vector_store
+        server.vector_store = server.LocalVectorStore("other_index", 8)
+        try:
+            assert server.manifest_file_hash("notes.txt") is None
+            assert server.manifest_node_ids("notes.txt") == set()
+            server.update_manifest("notes.txt", "hash1", {"node1": "chunk1"})
+        finally:
+            server.vector_store.close()
+            server.vector_store = local
+        assert server.manifest_node_ids("notes.txt") == {"node1"}
+    finally:
+        server.manifest.close()
+
+def test_legacy_manifest_is_assigned_to_neo4j(server):
+    legacy = sqlite3.connect("index_manifest.db")
+    legacy.execute("CREATE TABLE files (file_key TEXT NOT NULL, embed_model TEXT NOT NULL, file_hash TEXT NOT NULL, updated TEXT, PRIMARY KEY (file_key, embed_model))")
+    legacy.execute("CREATE TABLE chunks (node_id TEXT PRIMARY KEY, file_key TEXT NOT NULL, embed_model TEXT NOT NULL, chunk_hash TEXT NOT NULL)")
+    legacy.execute("INSERT INTO files VALUES ('notes.txt', 'mock', 'hash1', NULL)")
+    legacy.execute("INSERT INTO chunks VALUES ('node1', 'notes.txt', 'mock', 'chunk1')")
+    legacy.commit()
+    legacy.close()
+
+    server.init_manifest()
+    try:
+        # The configured backend is the local one, which has never ingested the file
+        assert server.manifest_file_hash("notes.txt") is None
+        rows = server.manifest.execute("SELECT store, node_id FROM chunks").fetchall()
+        assert rows == [(server.neo4j_store_key(), "node1")]
+    finally:
+        server.manifest.close()
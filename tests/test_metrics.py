@@ -0,0 +1,46 @@
+import threading
+
+from metrics import FOLD_EVERY, Registry
+
+def run_in_threads(count, target):
+    for _ in range(count):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+def test_exited_threads_are_folded_without_a_scrape():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+
+    def handle():
+        requests.inc()
+        latency.observe(0.5)
+    run_in_threads(10 * FOLD_EVERY, handle)
+
+    # A thread per request, as with a threaded server, only leaves the shards of the last few around
+    assert len(registry.shards) + len(registry.new_shards) <= FOLD_EVERY
+    totals = registry.totals()
+    assert totals[("requests_total", ())] == 10 * FOLD_EVERY
+    assert totals[("latency_seconds", ())] == [0, 10 * FOLD_EVERY, 0, 0.5 * 10 * FOLD_EVERY, 10 * FOLD_EVERY]
+    assert registry.shards == [] and not registry.new_shards
+
+def test_live_shards_are_read_at_scrape_time():
+    registry = Registry()
+    active = registry.gauge("active", "Active", ("kind",))
+    started, finish = threading.Event(), threading.Event()
+
+    def work():
+        active.inc("stream")
+        started.set()
+        finish.wait()
+        active.dec("stream")
+    thread = threading.Thread(target=work)
+    thread.start()
+    started.wait()
+    active.inc("stream")
+    assert registry.totals()[("active", ("stream",))] == 2
+    finish.set()
+    thread.join()
+    assert registry.totals()[("active", ("stream",))] == 1
+    assert 'active{kind="stream"} 1.0' in registry.render()
@@ -0,0 +1,29 @@
+import threading
+from types import SimpleNamespace
+
+class FakeDriver:
+    def __init__(self, in_use):
+        self.connection = SimpleNamespace(in_use=in_use)
+        self._pool = SimpleNamespace(connections={"localhost:7687": [self.connection]})
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+def test_retired_driver_is_closed_once_its_queries_are_done(server, monkeypatch):
+    old_driver = FakeDriver(in_use=True)
+    monkeypatch.setattr(server, "neo4j_driver", old_driver)
+    server.retire_neo4j_driver()
+
+    # Stores opened from now on don't get the old driver, queries still running on it keep it open
+    assert server.current_neo4j_driver() is None
+    assert not old_driver.closed.wait(1)
+    old_driver.connection.in_use = False
+    assert old_driver.closed.wait(5)
+
+def test_retired_driver_is_closed_after_the_drain_timeout(server, monkeypatch):
+    old_driver = FakeDriver(in_use=True)
+    monkeypatch.setattr(server, "neo4j_driver", old_driver)
+    monkeypatch.setattr(server, "NEO4J_DRAIN_SECONDS", 0.2)
+    server.retire_neo4j_driver()
+    assert old_driver.closed.wait(5)
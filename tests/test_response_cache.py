@@ -0,0 +1,30 @@
+from llama_index.core.llms.mock import MockLLM
+
+def test_cache_hits_need_the_same_history(server, ask):
+    server.settings["response_cache"] = True
+    server.response_cache.clear()
+    first, second = server.ChatSession("first"), server.ChatSession("second")
+
+    assert ask(first, "what is a vector index")["cached_answer"] is None
+    # A new conversation asking the same question gets the answer from the cache
+    assert ask(second, "what is a vector index")["cached_answer"] is not None
+    # So does a follow-up after the same history, but not one after another history
+    assert ask(first, "and why")["cached_answer"] is None
+    assert ask(second, "and why")["cached_answer"] is not None
+    third = server.ChatSession("third")
+    ask(third, "what is a keyword index")
+    assert ask(third, "and why")["cached_answer"] is None
+
+def test_a_cache_miss_condenses_once(server, ask, monkeypatch):
+    server.settings["response_cache"] = True
+    server.response_cache.clear()
+    completions = []
+    complete = MockLLM.complete
+    monkeypatch.setattr(MockLLM, "complete", lambda self, prompt, **kwargs: completions.append(prompt) or complete(self, prompt, **kwargs))
+
+    chat = server.ChatSession("client")
+    ask(chat, "first question")
+    assert completions == []
+    ask(chat, "follow-up question")
+    # Only the chat engine condenses the follow-up, the cache key doesn't
+    assert len(completions) == 1
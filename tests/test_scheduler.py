@@ -0,0 +1,185 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+def query(asgi_app, payload, session_id="scheduler", disconnect=None):
+    # A POST to /api/query through the ASGI app, returns the status and the body. Once the disconnect
+    # event is set the client is gone, like a browser tab that was closed
+    body = json.dumps(payload).encode()
+
+    async def receive():
+        nonlocal body
+        if body is not None:
+            message, body = {"type": "http.request", "body": body, "more_body": False}, None
+            return message
+        await (disconnect.wait() if disconnect else asyncio.Future())
+        return {"type": "http.disconnect"}
+
+    messages = []
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {"type": "http", "http_version": "1.1", "method": "POST", "scheme": "http", "path": "/api/query",
+                 "raw_path": b"/api/query", "query_string": b"", "root_path": "",
+                 "headers": [(b"x-session-id", session_id.encode()), (b"content-type", b"application/json")],
+                 "server": ("127.0.0.1", 8000), "client": ("127.0.0.1", 50000)}
+        await asgi_app(scope, receive, send)
+        if not messages:
+            return None, b""
+        return messages[0]["status"], b"".join(message.get("body", b"") for message in messages[1:])
+    return run()
+
+@pytest.fixture
+def scheduler(server, monkeypatch):
+    # A fresh scheduler with a single slot, used by the query route as well
+    monkeypatch.setitem(server.settings, "llm_max_concurrency", 1)
+    monkeypatch.setitem(server.settings, "llm_queue_timeout", 5)
+    scheduler = server.LLMScheduler()
+    monkeypatch.setattr(server, "llm_scheduler", scheduler)
+    server.startup_done.set()
+    yield scheduler
+    server.startup_done.clear()
+
+def test_sessions_take_turns(scheduler):
+    order = []
+
+    async def request(session_id):
+        started = await scheduler.acquire_async(session_id)
+        order.append(session_id)
+        await asyncio.sleep(0)
+        scheduler.release(started)
+
+    async def run():
+        held = await scheduler.acquire_async("held")
+        tasks = []
+        for session_id in ["a", "a", "a", "b"]:
+            tasks.append(asyncio.ensure_future(request(session_id)))
+            await asyncio.sleep(0)
+        assert scheduler.stats()["queued_interactive"] == 4
+        scheduler.release(held)
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+
+    assert order == ["a", "b", "a", "a"]
+    assert scheduler.stats()["running"] == 0
+
+def test_interactive_requests_go_before_background_work(scheduler):
+    order = []
+    held = scheduler.acquire("held")
+
+    def background():
+        with scheduler.slot("titles", scheduler.BACKGROUND):
+            order.append("titles")
+    worker = threading.Thread(target=background)
+    worker.start()
+
+    async def run():
+        while scheduler.stats()["queued_background"] == 0:
+            await asyncio.sleep(0.01)
+        admission = asyncio.ensure_future(scheduler.acquire_async("chat"))
+        await asyncio.sleep(0)
+        scheduler.release(held)
+        started = await admission
+        order.append("chat")
+        scheduler.release(started)
+    asyncio.run(run())
+    worker.join(5)
+
+    assert order == ["chat", "titles"]
+    assert scheduler.stats()["running"] == 0
+
+def test_cancelled_wait_releases_a_slot_it_was_given(scheduler):
+    async def run():
+        held = await scheduler.acquire_async("held")
+        admission = asyncio.ensure_future(scheduler.acquire_async("chat"))
+        await asyncio.sleep(0)
+        # The slot is handed over, but the waiter is cancelled before it sees it
+        scheduler.release(held)
+        admission.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await admission
+        await asyncio.sleep(0)
+    asyncio.run(run())
+
+    stats = scheduler.stats()
+    assert stats["running"] == 0
+    assert stats["queued_interactive"] == 0
+
+def test_queue_timeout_is_a_429(server, scheduler, monkeypatch):
+    monkeypatch.setitem(server.settings, "llm_queue_timeout", 0.2)
+    held = scheduler.acquire("held")
+    status, body = asyncio.run(query(server.asgi_app, {"query": "hello"}))
+    scheduler.release(held)
+
+    assert status == 429
+    assert json.loads(body)["retry_after"] >= 1
+    stats = scheduler.stats()
+    assert stats["rejected"] == 1
+    assert stats["queued_interactive"] == 0
+    assert stats["running"] == 0
+
+def test_queued_queries_leave_threads_to_admitted_streams(server, scheduler):
+    # With fewer worker threads than queued requests, the admitted ones still get threads to finish on
+    async def run():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=2))
+        return await asyncio.gather(*(query(server.asgi_app, {"query": f"question {i}"}, session_id=f"s{i}")
+                                      for i in range(8)))
+    responses = asyncio.run(run())
+
+    assert [status for status, _ in responses] == [200] * 8
+    assert scheduler.stats()["admitted"] == 8
+
+def test_disconnect_while_queued_gives_up_the_place(server, scheduler):
+    held = scheduler.acquire("held")
+
+    async def run():
+        disconnect = asyncio.Event()
+        request = asyncio.ensure_future(query(server.asgi_app, {"query": "hello"}, disconnect=disconnect))
+        while scheduler.stats()["queued_interactive"] == 0:
+            await asyncio.sleep(0.01)
+        disconnect.set()
+        return await request
+    status, _ = asyncio.run(run())
+
+    assert status is None
+    assert scheduler.stats()["queued_interactive"] == 0
+    scheduler.release(held)
+    assert scheduler.stats()["running"] == 0
+
+class EndlessLLM:
+    # Streams tokens until the consumer closes the stream
+    def __init__(self):
+        self.closed = asyncio.Event()
+
+    async def astream_chat(self, messages):
+        async def tokens():
+            try:
+                while True:
+                    await asyncio.sleep(0.01)
+                    yield type("Chunk", (), {"delta": "token "})()
+            finally:
+                self.closed.set()
+        return tokens()
+
+def test_disconnect_mid_stream_releases_the_slot(server, scheduler, monkeypatch):
+    endless = EndlessLLM()
+    monkeypatch.setattr(server, "llm", endless)
+
+    async def run():
+        disconnect = asyncio.Event()
+        request = asyncio.ensure_future(query(server.asgi_app, {"query": "hello"}, disconnect=disconnect))
+        while scheduler.stats()["running"] == 0:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        disconnect.set()
+        status, _ = await asyncio.wait_for(request, 5)
+        return status, endless.closed.is_set()
+    status, closed = asyncio.run(run())
+
+    assert status == 200
+    assert closed
+    assert scheduler.stats()["running"] == 0
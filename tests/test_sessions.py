@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+from werkzeug.http import parse_cookie
+
+def test_new_client_gets_a_session_cookie(server):
+    response = server.app.test_client().get("/api/ready")
+    cookie = response.headers["Set-Cookie"]
+    assert cookie.startswith("tok_session=")
+    assert "HttpOnly" in cookie and "SameSite=Lax" in cookie
+
+def test_cookie_names_the_session_of_the_request(server):
+    with server.app.test_request_context("/api/new_chat"):
+        chat = server.get_chat_session()
+        response = server.issue_session_cookie(server.app.response_class())
+    assert parse_cookie(response.headers["Set-Cookie"])["tok_session"] == chat.id
+
+def test_known_clients_get_no_cookie(server):
+    client = server.app.test_client()
+    assert "Set-Cookie" not in client.get("/api/ready", headers={"X-Session-Id": "api-client"}).headers
+    client.set_cookie("tok_session", "browser")
+    assert "Set-Cookie" not in client.get("/api/ready").headers
+
+def test_lookups_evict_idle_sessions(server):
+    server.settings["session_idle_timeout"] = 60
+    idle = server.get_chat_session("idle")
+    active = server.get_chat_session("active")
+    idle.last_used = time.time() - 120
+    assert server.get_chat_session("active") is active
+    assert "idle" not in server.chat_sessions
+
+def test_resumed_session_date_is_refreshed_once(server, ask):
+    chat = server.ChatSession("client")
+    ask(chat, "first question")
+    server.close_session_logs()
+    filename = server.catalog_key(chat.session_file)
+
+    with server.app.test_request_context("/api/choose_chat_history", json={"filename": filename}, headers={"X-Session-Id": "resumed"}):
+        assert server.choose_chat_history().status_code == 200
+    resumed = server.get_chat_session("resumed")
+    ask(resumed, "second question")
+    ask(resumed, "third question")
+    server.close_session_logs()
+
+    with open(chat.session_file, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    # The header of the first turn, then one refresh for the resumed turns
+    assert [record for record in records if set(record) == {"date"}] == [records[-3]]
+    assert [record["query"] for record in records if "query" in record] == ["first question", "second question", "third question"]
+
+def write_json(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(records, f)
+
+def test_old_session_files_are_migrated_to_json_lines(server):
+    records = [{"title": "Old chat", "date": "2024-01-01 10:00:00"}, {"query": "hi", "response": "hello"}]
+    write_json(os.path.join("prev_msgs", "session_1.json"), records)
+    server.migrate_session_files()
+
+    assert not os.path.exists(os.path.join("prev_msgs", "session_1.json"))
+    assert server.read_session(os.path.join("prev_msgs", "session_1.jsonl")) == records
+
+def test_torn_last_line_is_skipped(server):
+    path = os.path.join("prev_msgs", "session_torn.jsonl")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('{"title": "Torn", "date": "2024-01-01 10:00:00"}\n{"query": "hi", "response": "hello"}\n'
+                '{"summary": "greetings"}\n{"query": "and then", "resp')
+    header, turns, summary = server.read_session_records(path)
+
+    assert header == {"title": "Torn", "date": "2024-01-01 10:00:00"}
+    assert turns == [{"query": "hi", "response": "hello"}]
+    assert summary == {"summary": "greetings"}
+
+def test_catalog_is_backfilled_from_session_files(server):
+    write_json(os.path.join("prev_msgs", "session_1.json"), [{"title": "Old chat", "date": "2024-01-01 10:00:00"}, {"query": "hi", "response": "hello"}])
+    os.makedirs(os.path.join("prev_msgs", "2024-02"))
+    with open(os.path.join("prev_msgs", "2024-02", "session_2.jsonl"), "w", encoding="utf-8") as f:
+        f.write('{"title": "New chat", "date": "2024-02-01 10:00:00"}\n{"query": "a", "response": "b"}\n{"query": "c", "response": "d"}\n')
+    server.catalog.close()
+    server.init_catalog()
+
+    rows = server.catalog.execute("SELECT filename, title, created, message_count FROM sessions ORDER BY filename").fetchall()
+    assert rows == [("2024-02/session_2.jsonl", "New chat", "2024-02-01 10:00:00", 2),
+                    ("session_1.json", "Old chat", "2024-01-01 10:00:00", 1)]
+
+def test_catalog_follows_saved_turns(server):
+    session = server.start_new_session()
+    server.save_to_session(session, {"title": "Chat", "date": "2024-01-01 10:00:00"})
+    server.save_to_session(session, {"query": "a", "response": "b"})
+    server.save_to_session(session, {"query": "c", "response": "d"}, refresh_date=True)
+
+    key = server.catalog_key(session)
+    assert server.find_in_catalog(key)
+    assert server.catalog.execute("SELECT title, message_count FROM sessions WHERE filename = ?", (key,)).fetchone() == ("Chat", 2)
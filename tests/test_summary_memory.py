@@ -0,0 +1,30 @@
+def user_messages(memory):
+    return [message.content for message in memory.get_all() if message.role.value == "user"]
+
+def test_chat_engine_records_each_question_once(server, ask):
+    chat = server.ChatSession("client")
+    ask(chat, "first question")
+    ask(chat, "second question")
+    assert user_messages(chat.memory) == ["first question", "second question"]
+
+def test_resume_after_fold_on_chat_engine_path(server, ask):
+    server.settings.update({"memory_recent_turns": 2, "memory_summarize_every": 3})
+    chat = server.ChatSession("client")
+    questions = [f"question {i}" for i in range(8)]
+    for question in questions:
+        ask(chat, question)
+        server.summarize_session(chat.session_file, chat.memory)
+
+    # Three turns are folded after turns 5 and 8, the last two stay verbatim
+    assert chat.memory.summarized_turns == 6
+    assert user_messages(chat.memory) == questions[6:]
+
+    server.close_session_logs()
+    _, turns, summary = server.read_session_records(chat.session_file)
+    assert [turn["query"] for turn in turns] == questions
+    resumed = server.load_session_memory(turns, summary)
+    assert resumed.summary == chat.memory.summary
+    assert resumed.summarized_turns == 6
+    assert user_messages(resumed) == questions[6:]
+    # The engine strips the answer it records, the session keeps it as streamed
+    assert [message.content.strip() for message in resumed.get_all()] == [message.content.strip() for message in chat.memory.get_all()]